@@ -0,0 +1,176 @@
+import os
+import logging
+
+import numpy as np
+import shapely
+import shapely.geometry
+from affine import Affine
+
+from app.store import cache_redis, cache_ttl, get_stored_value, decode_features
+from app.lib.delineation import delineate_point, shapes_to_geojson, simplify_cells
+from app.lib.grids import grids
+from app.lib.index import get_upstream_index
+from app.lib.polygons import polygonize
+from app.lib.regions import get_region
+from app.lib.tracing import outlet_cell, cell_at
+from app.lib.utils import cache_version, make_cell_key
+
+import dotenv
+
+dotenv.load_dotenv()
+
+# catchments of fewer cells than this are traced as usual, without looking for cached catchments upstream
+compose_min_cells = int(os.environ.get('COMPOSE_MIN_CELLS', 10000))
+
+# share of a catchment's cells that cached catchments upstream must cover for it to be composed from them
+compose_min_share = float(os.environ.get('COMPOSE_MIN_SHARE', 0.5))
+
+
+def locate_cell(lon, lat, res):
+    """
+    Find the grid cell of an outlet, from the grid's metadata alone, so looking up a cached catchment never opens the
+    grid.
+
+    :return: (region, row, col) tuple
+    """
+    region = get_region(lon, lat)
+    meta = grids.get_meta(region, res)
+    row, col = cell_at(Affine(*meta['affine'][:6]), meta['shape'], lon, lat)
+    return region, row, col
+
+
+def cells_key(region, res, remove_sinks):
+    """
+    Key of the sorted set of cells with cached catchments in a grid, scored by their position in the upstream index
+    (see `app.lib.index.build_upstream_index`), so that the cached catchments upstream of a cell are a range query.
+    """
+    return f'cells:v{cache_version}:{region}:{res}:{remove_sinks}'
+
+
+def register_cell(index, region, res, row, col, remove_sinks):
+    key = cells_key(region, res, remove_sinks)
+    cache_redis.zadd(key, {f'{row}:{col}': index.position(row, col)})
+    if cache_ttl:
+        cache_redis.expire(key, cache_ttl)
+
+
+def find_cached_pieces(index, region, res, row, col, remove_sinks):
+    """
+    Find the largest cached catchments upstream of a cell, none inside another.
+
+    :return: List of (position, size, value) tuples of each catchment's position in the upstream index, its number of
+        cells and its stored value, in upstream index order
+    """
+    position = index.position(row, col)
+    end = position + int(index.ups[row * index.shape[1] + col])
+    cached = cache_redis.zrangebyscore(cells_key(region, res, remove_sinks), position + 1, end - 1, withscores=True)
+
+    pieces = []
+    covered = position + 1
+    for member, score in cached:
+        start = int(score)
+        if start < covered:
+            # inside a catchment already found
+            continue
+        piece_row, piece_col = (int(i) for i in member.decode().split(':'))
+        value = get_stored_value(make_cell_key(region, res, piece_row, piece_col, remove_sinks=remove_sinks))
+        if not value:
+            # evicted since; the catchments inside it may still be cached
+            continue
+        size = int(index.ups[piece_row * index.shape[1] + piece_col])
+        pieces.append((start, size, value))
+        covered = start + size
+
+    return pieces
+
+
+def snap_to_corners(geometries, affine):
+    """
+    Snap the vertices of polygonized catchments to the exact corners of the grid's cells.
+
+    Pieces polygonized from rasters with different offsets put the same corner at slightly different coordinates;
+    snapped, their shared edges match exactly, and union without slivers.
+    """
+
+    def snap(coords):
+        cols = np.round((coords[:, 0] - affine.c) / affine.a)
+        rows = np.round((coords[:, 1] - affine.f) / affine.e)
+        return np.column_stack([affine.c + cols * affine.a, affine.f + rows * affine.e])
+
+    return shapely.transform(geometries, snap)
+
+
+def compose(index, affine, region, res, row, col, remove_sinks):
+    """
+    Compose the catchment above a cell from the cached catchments upstream of it, polygonizing only the rest.
+
+    :return: List of (GeoJSON geometry, value) tuples, like `app.lib.polygons.polygonize`, or None if too little of
+        the catchment is cached
+    """
+    position = index.position(row, col)
+    size = int(index.ups[row * index.shape[1] + col])
+    if size < compose_min_cells:
+        return None
+
+    pieces = find_cached_pieces(index, region, res, row, col, remove_sinks)
+    if sum(piece_size for _, piece_size, _ in pieces) < compose_min_share * size:
+        return None
+
+    # the cells not covered by cached catchments, as runs of the index between them
+    runs = []
+    cursor = position
+    for start, piece_size, _ in pieces:
+        runs.append(index.order[cursor:start])
+        cursor = start + piece_size
+    runs.append(index.order[cursor:position + size])
+    mask, mask_affine = index.rasterize(np.concatenate(runs), affine)
+
+    geometries = [shapely.geometry.shape(geometry) for geometry, _ in polygonize(mask, mask_affine)]
+    for _, _, value in pieces:
+        geometries.extend(decode_features(value)[1])
+
+    catchment = shapely.union_all(snap_to_corners(np.array(geometries), affine))
+    logging.info(f'Composed a catchment of {size} cells from {len(pieces)} cached catchments')
+    return [(shapely.geometry.mapping(polygon), 1.0) for polygon in shapely.get_parts(catchment)]
+
+
+def delineate_cell(lon, lat, res=30, remove_sinks=False):
+    """
+    Delineate the catchment above a point, as `app.lib.delineation.delineate_point` does, but composed from cached
+    catchments upstream where they cover most of it (see `compose`).
+
+    Only catchments with sinks removed are composed. Filling the sinks of a whole large catchment costs more than
+    composing it; with its sinks kept, delineating it afresh is quicker.
+
+    The outlet's cell is recorded as cached, for catchments downstream; callers are expected to store the result
+    under its cell key (see `app.lib.utils.make_cell_key`).
+    """
+    region = get_region(lon, lat)
+    if not remove_sinks:
+        return delineate_point(lon, lat, res=res, region=region, remove_sinks=remove_sinks)
+
+    fdir = grids.get_raster(region, res)
+    index = get_upstream_index(region, res)
+    if index is None or cache_redis is None or simplify_cells:
+        # simplified outlines no longer share edges, so can't be composed
+        return delineate_point(lon, lat, res=res, region=region, remove_sinks=remove_sinks)
+
+    row, col = outlet_cell(fdir, lon, lat)
+    if index.position(row, col) is None:
+        return delineate_point(lon, lat, res=res, region=region, remove_sinks=remove_sinks)
+
+    try:
+        shapes = compose(index, fdir.affine, region, res, row, col, remove_sinks)
+    except Exception as err:
+        logging.warning(f'Could not compose the catchment of ({lon}, {lat}): {err}')
+        shapes = None
+    if shapes:
+        result = shapes_to_geojson(lon, lat, shapes, region=region, remove_sinks=remove_sinks)
+    else:
+        result = delineate_point(lon, lat, res=res, region=region, remove_sinks=remove_sinks)
+
+    try:
+        register_cell(index, region, res, row, col, remove_sinks)
+    except Exception as err:
+        logging.warning(f'Could not record the cached catchment of ({lon}, {lat}): {err}')
+    return result
@@ -0,0 +1,150 @@
+import os
+import time
+import asyncio
+import logging
+
+from redis.exceptions import LockError
+
+from app.metrics import metrics
+from app.store import redis, async_redis, cache_redis, cache_async_redis, local_cache, is_storable
+
+import dotenv
+
+dotenv.load_dotenv()
+
+# seconds a worker may hold the pending marker for a key before others assume it failed
+pending_ttl = int(os.environ.get('PENDING_TTL', 300))
+
+# longest wait, in seconds, between checks for a result being computed elsewhere
+max_poll_interval = 1.0
+
+
+def pending_key(key):
+    return f'pending:{key}'
+
+
+def uncached_key(key):
+    """
+    Key marking a result as too large to store (see `app.store.is_storable`), so that waiting for it is pointless.
+    """
+    return f'uncached:{key}'
+
+
+def _backoff(interval):
+    return min(interval * 2, max_poll_interval)
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent requests for the same uncached result, so it is computed once.
+
+    Within a process, callers asking for a key that is already being computed await that computation. Across
+    processes (API workers and Celery workers), a Redis lock marks the key as pending; whoever holds it computes and
+    stores the result, and everyone else waits for the stored value. If the holder dies, its lock expires after
+    `pending_ttl` seconds and a waiting caller takes over.
+
+    A result too large to store can't be handed over like this, so the holder marks it as uncached for `pending_ttl`
+    seconds instead. Callers then compute it themselves, side by side, rather than taking the lock one after another.
+    """
+
+    def __init__(self):
+        self._flights = {}
+
+    async def run(self, key, compute):
+        """
+        Get the result for `key`, computing it with `compute` unless that is already happening elsewhere.
+
+        :param key: Cache key
+        :param compute: Coroutine function that computes, stores and returns the stored value
+        :return: The stored value
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = asyncio.ensure_future(self._lead_or_follow(key, compute))
+            self._flights[key] = flight
+            flight.add_done_callback(lambda _: self._flights.pop(key, None))
+        else:
+            metrics.incr('coalesced_local')
+        return await asyncio.shield(flight)
+
+    async def _lead_or_follow(self, key, compute):
+        if async_redis is None:
+            return await compute()
+
+        while True:
+            if await async_redis.exists(uncached_key(key)):
+                return await compute()
+
+            lock = async_redis.lock(pending_key(key), timeout=pending_ttl)
+            if await lock.acquire(blocking=False):
+                try:
+                    value = await compute()
+                    if not is_storable(value):
+                        await async_redis.set(uncached_key(key), 1, ex=pending_ttl)
+                    return value
+                finally:
+                    try:
+                        await lock.release()
+                    except LockError:
+                        logging.warning(f'Pending marker for {key} expired before the result was stored')
+
+            metrics.incr('coalesced_remote')
+            value = await self._wait(key)
+            if value:
+                local_cache.set(key, value)
+                return value
+
+    @staticmethod
+    async def _wait(key):
+        interval = 0.05
+        while True:
+            value = await cache_async_redis.get(key)
+            if value:
+                return value
+            if not await async_redis.exists(pending_key(key)):
+                # one last look, in case the result was stored just before the marker was released
+                return await cache_async_redis.get(key)
+            await asyncio.sleep(interval)
+            interval = _backoff(interval)
+
+
+single_flight = SingleFlight()
+
+
+def run_once(key, compute):
+    """
+    Blocking counterpart of `SingleFlight.run`, coordinating through Redis only (e.g., for Celery tasks).
+    """
+    if redis is None:
+        return compute()
+
+    while True:
+        if redis.exists(uncached_key(key)):
+            return compute()
+
+        lock = redis.lock(pending_key(key), timeout=pending_ttl)
+        if lock.acquire(blocking=False):
+            try:
+                value = compute()
+                if not is_storable(value):
+                    redis.set(uncached_key(key), 1, ex=pending_ttl)
+                return value
+            finally:
+                try:
+                    lock.release()
+                except LockError:
+                    logging.warning(f'Pending marker for {key} expired before the result was stored')
+
+        metrics.incr('coalesced_remote')
+        interval = 0.05
+        while True:
+            value = cache_redis.get(key)
+            if value:
+                return value
+            if not redis.exists(pending_key(key)):
+                value = cache_redis.get(key)
+                if value:
+                    return value
+                break
+            time.sleep(interval)
+            interval = _backoff(interval)
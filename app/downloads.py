@@ -0,0 +1,141 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import dotenv
+
+dotenv.load_dotenv()
+
+# files downloaded at once
+download_workers = int(os.environ.get('DOWNLOAD_WORKERS', 4))
+
+# attempts at each file, resuming where the last one stopped
+download_attempts = int(os.environ.get('DOWNLOAD_ATTEMPTS', 5))
+
+
+def sha256sum(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_checksum(url):
+    """
+    Get the published SHA-256 checksum of a file (at <url>.sha256, as written by sha256sum), or None if there isn't one.
+    """
+    req = requests.get(f'{url}.sha256', timeout=60)
+    if not req.ok:
+        return None
+    return req.text.split()[0].lower()
+
+
+class Downloader(object):
+    """
+    Downloads files by streaming them to disk, several at a time.
+
+    Each file is written to `<path>.part` and renamed once complete (and verified, if a checksum is given), so a
+    partial file never appears under the real name. If a download fails part way, it's retried from where it stopped
+    with an HTTP Range request, and an existing `.part` file from an earlier run is resumed the same way. Progress and
+    throughput are logged every `log_interval` seconds.
+    """
+
+    def __init__(self, max_workers=download_workers, attempts=download_attempts, chunk_size=1 << 20,
+                 log_interval=10):
+        self.max_workers = max_workers
+        self.attempts = attempts
+        self.chunk_size = chunk_size
+        self.log_interval = log_interval
+        self.session = requests.Session()
+        self._lock = threading.Lock()
+        self._received = 0
+        self._started = None
+        self._logged = None
+
+    def download(self, url, path, checksum=None):
+        """
+        Download a file.
+
+        :param url: URL of the file
+        :param path: Where to save it
+        :param checksum: Optional SHA-256 checksum (hex) to verify the file against
+        :return: The path
+        """
+        tmp_path = f'{path}.part'
+        for attempt in range(1, self.attempts + 1):
+            try:
+                self._fetch(url, tmp_path)
+                break
+            except requests.RequestException as err:
+                # only connection problems and server errors are worth retrying
+                response = getattr(err, 'response', None)
+                if attempt == self.attempts or (response is not None and response.status_code < 500):
+                    raise
+                logging.warning(f'Download of {url} interrupted ({err}); resuming')
+                time.sleep(min(2 ** attempt, 30))
+
+        if checksum and sha256sum(tmp_path) != checksum:
+            os.remove(tmp_path)
+            raise Exception(f'Checksum mismatch for {url}')
+
+        os.replace(tmp_path, path)
+        logging.info(f'Downloaded {os.path.basename(path)} ({os.path.getsize(path) / 1e6:.1f} MB)')
+        return path
+
+    def download_all(self, files):
+        """
+        Download many files at once, at most `max_workers` at a time.
+
+        :param files: List of (url, path, checksum) tuples
+        :return: List of paths
+        """
+        if not files:
+            return []
+        self._received = 0
+        self._started = self._logged = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            paths = list(pool.map(lambda args: self.download(*args), files))
+        self._log_progress(force=True)
+        return paths
+
+    def _fetch(self, url, tmp_path):
+        offset = os.path.getsize(tmp_path) if os.path.exists(tmp_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        with self.session.get(url, headers=headers, stream=True, timeout=60) as req:
+            if req.status_code == 416:
+                # the partial file is already complete
+                return
+            req.raise_for_status()
+
+            # servers that ignore the Range header send the whole file again
+            mode = 'ab' if req.status_code == 206 else 'wb'
+            with open(tmp_path, mode) as f:
+                for chunk in req.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+                    self._progress(len(chunk))
+
+    def _progress(self, nbytes):
+        with self._lock:
+            self._received += nbytes
+        self._log_progress()
+
+    def _log_progress(self, force=False):
+        if self._started is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._logged < self.log_interval:
+                return
+            self._logged = now
+            received = self._received
+        elapsed = max(now - self._started, 1e-6)
+        logging.info(f'Downloaded {received / 1e6:.1f} MB in {elapsed:.0f} s ({received / 1e6 / elapsed:.1f} MB/s)')
+
+
+downloader = Downloader()
@@ -0,0 +1,99 @@
+import os
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import dotenv
+
+dotenv.load_dotenv()
+
+# processes used by each API worker for CPU-bound delineation
+delineation_workers = int(os.environ.get('DELINEATION_WORKERS', 2))
+
+# requests each API worker accepts for delineation (running or waiting) before it starts refusing them
+max_pending_delineations = int(os.environ.get('MAX_PENDING_DELINEATIONS', 32))
+
+
+class Saturated(Exception):
+    pass
+
+
+class DelineationExecutor(object):
+    """
+    Runs blocking delineation work off the event loop.
+
+    CPU-bound work goes to a process pool, and blocking waits (e.g., on Celery results) go to threads. Either way,
+    at most `max_pending` calls may be outstanding at once; beyond that, `Saturated` is raised right away so the
+    caller can shed load instead of queueing without bound.
+    """
+
+    def __init__(self, max_workers=delineation_workers, max_pending=max_pending_delineations, initializer=None,
+                 initargs=()):
+        """
+        :param initializer: Function each process runs when it starts (e.g., to load grids), with `initargs`
+        """
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.initializer = initializer
+        self.initargs = initargs
+        self.pending = 0
+        self._pool = None
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            # spawn, rather than fork, since the parent is running an event loop and threads
+            context = multiprocessing.get_context('spawn')
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context,
+                                             initializer=self.initializer, initargs=self.initargs)
+        return self._pool
+
+    def start(self):
+        """
+        Start every process in the pool now, and wait until they have run the initializer, rather than starting them
+        on the first delineations.
+        """
+        futures = [self.pool.submit(os.getpid) for _ in range(self.max_workers)]
+        for future in futures:
+            future.result()
+
+    def check(self, n=1):
+        """
+        Raise `Saturated` unless `n` more calls would be accepted right now.
+        """
+        if self.pending + n > self.max_pending:
+            raise Saturated(f'{self.pending} delineations already pending')
+
+    def _acquire(self):
+        self.check()
+        self.pending += 1
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Run a CPU-bound function in the process pool.
+        """
+        self._acquire()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.pool, partial(fn, *args, **kwargs))
+        finally:
+            self.pending -= 1
+
+    async def run_in_thread(self, fn, *args, **kwargs):
+        """
+        Run a blocking, but not CPU-bound, function in a thread.
+        """
+        self._acquire()
+        try:
+            return await asyncio.to_thread(fn, *args, **kwargs)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+executor = DelineationExecutor()
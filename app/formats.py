@@ -0,0 +1,175 @@
+import io
+import json
+
+import numpy as np
+import shapely
+
+from app.lib.tiles import tile_bounds
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import mapbox_vector_tile
+except ImportError:
+    mapbox_vector_tile = None
+
+# binary formats catchments can be returned in, by name (as in the `format` query parameter) and media type
+media_types = {
+    'wkb': 'application/wkb',
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'mvt': 'application/vnd.mapbox-vector-tile',
+}
+
+# optional packages each format needs
+requirements = {
+    'parquet': ('pyarrow', lambda: pyarrow),
+    'arrow': ('pyarrow', lambda: pyarrow),
+    'mvt': ('mapbox-vector-tile', lambda: mapbox_vector_tile),
+}
+
+mvt_extent = 4096
+mvt_buffer = 64
+
+
+class UnsupportedFormat(Exception):
+    pass
+
+
+def negotiate(accept='', format=None):
+    """
+    Pick the format of a response, from the `format` query parameter if given, or else the Accept header.
+
+    :return: Name of a binary format (see `media_types`), or None for GeoJSON
+    """
+    if format:
+        if format in ('json', 'geojson'):
+            return None
+        if format not in media_types:
+            raise UnsupportedFormat(f'Unknown format: {format}')
+        name = format
+    else:
+        accepted = [media_type.split(';')[0].strip() for media_type in accept.split(',')]
+        name = next((name for name, media_type in media_types.items() if media_type in accepted), None)
+        if name is None:
+            return None
+
+    if name in requirements:
+        package, module = requirements[name]
+        if module() is None:
+            raise UnsupportedFormat(f'The {name} format requires {package}')
+    return name
+
+
+def split_features(geojson):
+    """
+    Split a FeatureCollection into its features' properties and shapely geometries.
+    """
+    features = geojson['features']
+    properties = [feature.get('properties') or {} for feature in features]
+    geometries = shapely.from_geojson([json.dumps(feature['geometry']) for feature in features]) if features \
+        else np.array([], dtype=object)
+    return properties, geometries
+
+
+def to_wkb(properties, geometries):
+    """
+    WKB of a catchment's geometry; of several catchments, a geometry collection of them in order.
+    """
+    geometry = geometries[0] if len(geometries) == 1 else shapely.geometrycollections(geometries)
+    return shapely.to_wkb(geometry)
+
+
+def to_table(properties, geometries):
+    """
+    Make an Arrow table of features, with WKB geometries and GeoParquet metadata.
+    """
+    columns = list(dict.fromkeys(key for props in properties for key in props))
+    data = {column: [props.get(column) for props in properties] for column in columns}
+    data['geometry'] = pyarrow.array(shapely.to_wkb(geometries), type=pyarrow.binary())
+
+    geometry_types = sorted(set(shapely.get_type_id(geometries).tolist()))
+    type_names = ['Point', 'LineString', 'LinearRing', 'Polygon', 'MultiPoint', 'MultiLineString', 'MultiPolygon',
+                  'GeometryCollection']
+    geo = {
+        'version': '1.0.0',
+        'primary_column': 'geometry',
+        'columns': {
+            'geometry': {
+                'encoding': 'WKB',
+                'geometry_types': [type_names[type_id] for type_id in geometry_types if type_id >= 0],
+                'bbox': list(shapely.total_bounds(geometries)) if len(geometries) else [],
+            }
+        },
+    }
+    table = pyarrow.table(data)
+    return table.replace_schema_metadata({'geo': json.dumps(geo)})
+
+
+def to_parquet(properties, geometries):
+    sink = io.BytesIO()
+    pyarrow.parquet.write_table(to_table(properties, geometries), sink)
+    return sink.getvalue()
+
+
+def to_arrow(properties, geometries):
+    table = to_table(properties, geometries)
+    sink = io.BytesIO()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+def to_web_mercator(coords):
+    lons, lats = coords[:, 0], np.clip(coords[:, 1], -85.0511, 85.0511)
+    x = np.radians(lons) * 6378137
+    y = np.log(np.tan(np.pi / 4 + np.radians(lats) / 2)) * 6378137
+    return np.column_stack([x, y])
+
+
+def to_mvt(properties, geometries, z, x, y, layer='catchments'):
+    """
+    Encode features as a Mapbox Vector Tile, clipped to tile z/x/y.
+    """
+    bounds = tile_bounds(z, x, y)
+    margin = (bounds[2] - bounds[0]) * mvt_buffer / mvt_extent
+    geometries = shapely.clip_by_rect(
+        shapely.transform(geometries, to_web_mercator),
+        bounds[0] - margin, bounds[1] - margin, bounds[2] + margin, bounds[3] + margin)
+
+    features = [
+        {'geometry': geometry, 'properties': {key: value for key, value in props.items() if value is not None}}
+        for props, geometry in zip(properties, geometries) if not shapely.is_empty(geometry)
+    ]
+    return mapbox_vector_tile.encode(
+        [{'name': layer, 'features': features}],
+        default_options={'quantize_bounds': bounds, 'extents': mvt_extent},
+    )
+
+
+def encode_features(name, properties, geometries, tile=None):
+    """
+    Encode features in a binary format.
+
+    :param name: Name of the format (see `media_types`)
+    :param tile: (z, x, y) tuple, for vector tiles
+    :return: (bytes, str) tuple of the encoded features and their media type
+    """
+    if name == 'wkb':
+        content = to_wkb(properties, geometries)
+    elif name == 'parquet':
+        content = to_parquet(properties, geometries)
+    elif name == 'arrow':
+        content = to_arrow(properties, geometries)
+    elif name == 'mvt':
+        if tile is None or None in tile:
+            raise UnsupportedFormat('Vector tiles need z, x and y')
+        content = to_mvt(properties, geometries, *tile)
+    else:
+        raise UnsupportedFormat(f'Unknown format: {name}')
+    return content, media_types[name]
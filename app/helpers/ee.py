@@ -1,13 +1,133 @@
 import os
 import json
+import time
+import logging
+import threading
 
 import ee
 
+from app.store import redis
+
+import dotenv
+
+dotenv.load_dotenv()
+
+# how long Earth Engine map ids (tile URL templates) are reused, and how long before they expire they are refreshed
+map_id_ttl = int(os.environ.get('MAP_ID_TTL', 4 * 60 * 60))
+map_id_refresh_margin = int(os.environ.get('MAP_ID_REFRESH_MARGIN', 30 * 60))
+
+
+class MapIdCache(object):
+    """
+    Cache of Earth Engine tile URL templates, shared between workers through Redis.
+
+    Each URL is kept for `ttl` seconds. Once it is within `refresh_margin` seconds of expiring, the next request for
+    it starts a new one in the background (one worker at a time) and meanwhile gets the cached URL, so requests only
+    wait on Earth Engine the first time a URL is asked for.
+    """
+
+    def __init__(self, redis=redis, ttl=map_id_ttl, refresh_margin=map_id_refresh_margin):
+        self.redis = redis
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self._entries = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, key, fetch):
+        """
+        Get a cached URL, or fetch it.
+
+        :param key: Key of the map (e.g., its dataset and visualization parameters)
+        :param fetch: Function making the map and returning its URL
+        """
+        entry = self._get_entry(key)
+        if entry is None:
+            return self._fetch(key, fetch)
+        url, expires = entry
+        if expires - time.time() < self.refresh_margin:
+            self._refresh_in_background(key, fetch)
+        return url
+
+    def _get_entry(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and entry[1] - now >= self.refresh_margin:
+            return entry
+
+        # expiring or missing here; another worker may have a newer one
+        if self.redis is not None:
+            try:
+                value = self.redis.get(f'mapid:{key}')
+            except Exception as err:
+                logging.warning(f'Could not get map id {key} from Redis: {err}')
+                value = None
+            if value:
+                data = json.loads(value)
+                if not entry or data['expires'] > entry[1]:
+                    entry = (data['url'], data['expires'])
+                    with self._lock:
+                        self._entries[key] = entry
+
+        return entry if entry and entry[1] > now else None
+
+    def _fetch(self, key, fetch):
+        url = fetch()
+        expires = time.time() + self.ttl
+        with self._lock:
+            self._entries[key] = (url, expires)
+        if self.redis is not None:
+            try:
+                self.redis.set(f'mapid:{key}', json.dumps({'url': url, 'expires': expires}), ex=self.ttl)
+            except Exception as err:
+                logging.warning(f'Could not store map id {key} in Redis: {err}')
+        return url
+
+    def _refresh_in_background(self, key, fetch):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        # one worker refreshes a given map id; the others pick it up from Redis
+        if self.redis is not None:
+            try:
+                claimed = self.redis.set(f'mapid:{key}:refreshing', 1, nx=True, ex=60)
+            except Exception:
+                claimed = True
+            if not claimed:
+                with self._lock:
+                    self._refreshing.discard(key)
+                return
+
+        threading.Thread(target=self._refresh, args=(key, fetch), daemon=True).start()
+
+    def _refresh(self, key, fetch):
+        try:
+            self._fetch(key, fetch)
+        except Exception as err:
+            logging.warning(f'Could not refresh map id {key}: {err}')
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
 
 class EarthEngineMap(object):
     ee = None
 
-    def __init__(self):
+    def __init__(self, module=None, map_ids=None):
+        """
+        :param module: An initialized `ee` module (or a stand-in, for testing); by default, `ee` is initialized with
+            the service account credentials in the environment
+        :param map_ids: Cache of map ids (see `MapIdCache`)
+        """
+        self.map_ids = map_ids or MapIdCache()
+
+        if module is not None:
+            self.ee = module
+            return
+
         # ee.Authenticate()
 
         service_account = os.environ.get('EE_CLIENT_EMAIL')
@@ -29,6 +149,13 @@ class EarthEngineMap(object):
             pass
 
     def get_streamlines_raster(self, resolution, threshold, showsinks=True, palette='0000FF', sink_color='red'):
+        if not self.ee:
+            raise Exception('Earth Engine not initialized')
+        key = f'streamlines:{resolution}:{threshold}:{showsinks}:{palette}:{sink_color}'
+        return self.map_ids.get(
+            key, lambda: self.make_streamlines_raster(resolution, threshold, showsinks, palette, sink_color))
+
+    def make_streamlines_raster(self, resolution, threshold, showsinks=True, palette='0000FF', sink_color='red'):
         facc_dataset = f'WWF/HydroSHEDS/{resolution}ACC'
 
         facc_image = self.ee.Image(facc_dataset)
@@ -42,7 +169,7 @@ class EarthEngineMap(object):
             sinks = fdir_image.updateMask(fdir_image.eq(255))
             sinks_visualized = sinks.visualize(palette=sink_color)
 
-            mosaic = ee.ImageCollection([streams_visualized, sinks_visualized]).mosaic()
+            mosaic = self.ee.ImageCollection([streams_visualized, sinks_visualized]).mosaic()
             map_id = mosaic.getMapId()
         else:
             map_id = streams_visualized.getMapId()
@@ -52,6 +179,10 @@ class EarthEngineMap(object):
     def get_earth_engine_map_tile_url(self, dataset, threshold, palette='0000FF'):
         if not self.ee:
             raise Exception('Earth Engine not initialized')
+        key = f'{dataset}:{threshold}:{palette}'
+        return self.map_ids.get(key, lambda: self.make_earth_engine_map_tile_url(dataset, threshold, palette))
+
+    def make_earth_engine_map_tile_url(self, dataset, threshold, palette='0000FF'):
         ee_image = self.ee.Image(dataset)
         map_id = None
         if dataset in ['WWF/HydroSHEDS/15ACC', 'WWF/HydroSHEDS/30ACC']:
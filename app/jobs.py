@@ -0,0 +1,160 @@
+import os
+import time
+import uuid
+
+import numpy as np
+
+from app.lib.delineation import unique_points
+from app.lib.regions import get_regions_bulk
+from app.store import redis, encode_result, decode_result
+
+import dotenv
+
+dotenv.load_dotenv()
+
+# seconds a batch job, and its results, are kept after it was last updated
+job_ttl = int(os.environ.get('JOB_TTL', 24 * 60 * 60))
+
+# number of a region's outlets delineated together in each of a job's tasks
+job_chunk_size = int(os.environ.get('JOB_CHUNK_SIZE', 100))
+
+
+def job_key(job_id):
+    return f'job:{job_id}'
+
+
+def results_key(job_id):
+    return f'job:{job_id}:results'
+
+
+def outlets_key(job_id):
+    return f'job:{job_id}:outlets'
+
+
+def create_job(features, res, remove_sinks):
+    """
+    Record a new batch job, with its outlets grouped by region, and split it into chunks of `job_chunk_size` outlets.
+
+    Outlets outside every region are recorded as failed right away.
+
+    :param features: List of GeoJSON point features
+    :return: Job id, and list of (region, start, stop) chunks (see `delineate_job_chunk`)
+    """
+    points = unique_points(features)
+    regions = get_regions_bulk(*np.array(points).reshape(-1, 2).T)
+
+    groups = {}
+    outside = []
+    for position, (point, region) in enumerate(zip(points, regions)):
+        if region is None:
+            outside.append(position)
+        else:
+            group = groups.setdefault(region, {'points': [], 'positions': []})
+            group['points'].append(point)
+            group['positions'].append(position)
+
+    job_id = uuid.uuid4().hex
+    key = job_key(job_id)
+    redis.hset(key, mapping={
+        'status': 'running',
+        'total': len(points),
+        'done': 0,
+        'res': res,
+        'remove_sinks': int(remove_sinks),
+        'created': time.time(),
+    })
+    redis.expire(key, job_ttl)
+    if groups:
+        redis.hset(outlets_key(job_id), mapping={region: encode_result(group) for region, group in groups.items()})
+        redis.expire(outlets_key(job_id), job_ttl)
+    if outside:
+        record_chunk(job_id, outside, error='No region found')
+
+    chunks = [(region, start, min(start + job_chunk_size, len(group['points'])))
+              for region, group in groups.items()
+              for start in range(0, len(group['points']), job_chunk_size)]
+
+    return job_id, chunks
+
+
+def get_job_outlets(job_id, region):
+    """
+    Get a job's outlets in a region.
+
+    :return: List of (lon, lat) outlets, and their positions among the job's distinct outlets
+    """
+    stored = redis.hget(outlets_key(job_id), region)
+    if not stored:
+        raise Exception(f'Job {job_id} has no outlets in {region}')
+    group = decode_result(stored)
+    return [tuple(point) for point in group['points']], group['positions']
+
+
+def record_chunk(job_id, positions, features=None, error=None):
+    """
+    Record the subcatchments (or the error) of a chunk of a job's outlets.
+
+    :param positions: Positions of the outlets among the job's distinct outlets
+    :param features: Subcatchment features, in the order of `positions`
+    """
+    result = {'positions': positions, 'features': features} if error is None else {'positions': positions, 'error': error}
+    key = results_key(job_id)
+    redis.hset(key, positions[0], encode_result(result))
+    redis.hincrby(job_key(job_id), 'done', len(positions))
+    redis.expire(key, job_ttl)
+    redis.expire(job_key(job_id), job_ttl)
+    redis.expire(outlets_key(job_id), job_ttl)
+
+
+def finish_job(job_id):
+    redis.hset(job_key(job_id), mapping={'status': 'done', 'finished': time.time()})
+
+
+def get_job(job_id):
+    """
+    Get a job's status and progress, or None if there is no such job (or it has expired).
+    """
+    job = redis.hgetall(job_key(job_id))
+    if not job:
+        return None
+    job = {key.decode(): value.decode() for key, value in job.items()}
+    done = int(job['done'])
+    total = int(job['total'])
+    return {
+        'id': job_id,
+        # every outlet is recorded, even if the chord marking the job done has lapsed
+        'status': 'done' if done >= total else job['status'],
+        'done': done,
+        'total': total,
+    }
+
+
+def get_job_results(job_id):
+    """
+    Get the subcatchments delineated so far by a job, in the order of its outlets.
+
+    :return: FeatureCollection of the subcatchments done so far, with the positions and errors of failed outlets
+        under `properties`, or None if there is no such job
+    """
+    job = get_job(job_id)
+    if job is None:
+        return None
+
+    done = []
+    errors = []
+    for value in redis.hvals(results_key(job_id)):
+        result = decode_result(value)
+        if 'error' in result:
+            errors.extend({'position': position, 'error': result['error']} for position in result['positions'])
+        else:
+            done.extend(zip(result['positions'], result['features']))
+    done.sort(key=lambda item: item[0])
+    errors.sort(key=lambda item: item['position'])
+
+    geojson = {
+        'type': 'FeatureCollection',
+        'features': [feature for _, feature in done],
+        'properties': dict(job, errors=errors),
+    }
+
+    return geojson
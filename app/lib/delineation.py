@@ -1,12 +1,18 @@
 import os
 import json
-from itertools import combinations
 
 import logging
 
-from pysheds.grid import Grid
 import shapely
+import shapely.geometry
 import numpy as np
+import rasterio.features
+
+from app.lib.grids import get_grid
+from app.lib.index import get_upstream_index
+from app.lib.polygons import polygonize
+from app.lib.regions import get_region, get_regions_bulk
+from app.lib.tracing import trace_catchment, trace_catchments
 
 import dotenv
 
@@ -14,24 +20,8 @@ dotenv.load_dotenv()
 
 logging.basicConfig(level=logging.INFO)
 
-data_dir = os.environ.get('DATA_DIR', './instance/data')
-
-
-def get_regions(lon, lat):
-    if 90 < lon < 190 and lat < 8:  # prioritize Australia
-        return ['au', 'as']
-    elif 57 < lon < 155 and 7 < lat < 55:  # prioritize Asia
-        return ['as', 'eu', 'au']
-    elif -30 < lon < 55 and lat < 35:  # prioritize Africa
-        return ['af', 'eu']
-    elif -25 < lon < 70 and 12 < lat:  # prioritize Europe
-        return ['eu', 'af', 'as']
-    elif -82 < lon < -34 and lat < 15:
-        return ['sa', 'na']
-    elif -140 < lon < -52 and 7 < lat < 62:
-        return ['na', 'sa']
-    else:
-        return ['na', 'sa', 'eu', 'af', 'as', 'au']
+# tolerance, in grid cells, to which catchment outlines are simplified (0 to keep every cell edge)
+simplify_cells = float(os.environ.get('SIMPLIFY_CELLS', 0))
 
 
 def shapes_to_geojson(lon, lat, shapes, region=None, remove_sinks=False, stringify=False):
@@ -69,106 +59,115 @@ def shapes_to_geojson(lon, lat, shapes, region=None, remove_sinks=False, stringi
     return geojson
 
 
-filename_tpl = 'hyd_{region}_{data}_{res}s.{ext}'
+def delineate_point(lon, lat, res=30, region=None, remove_sinks=False):
 
+    region = region or get_region(lon, lat)
+    _, fdir = get_grid(region, res)
 
-def get_region(lon, lat):
-    regions = get_regions(lon, lat)
-    point = shapely.Point(lon, lat)
-    for region in regions:
-        filename = f'{data_dir}/hyd_{region}_msk_30s.json'
-        with open(filename) as f:
-            gj_str = f.read()
-        gj_geom = shapely.from_geojson(gj_str)
+    # use the precomputed upstream index if there is one, otherwise trace with pysheds
+    index = get_upstream_index(region, res)
+    traced = index and index.trace(fdir, lon, lat)
+    grid, catchment = traced or trace_catchment(fdir, lon, lat)
+    tolerance = simplify_cells * abs(grid.affine.a)
+    shapes = polygonize(catchment, grid.affine, remove_sinks=remove_sinks, tolerance=tolerance)
 
-        if shapely.contains(gj_geom, point):
-            return region
+    result = shapes_to_geojson(lon, lat, shapes, region=region, remove_sinks=remove_sinks)
 
-    raise 'No region found'
+    return result
 
 
-def delineate_point(lon, lat, res=30, region=None, remove_sinks=False):
+def subcatchment_feature(point, geometry):
+    lon, lat = point
+    feature = {
+        'type': 'Feature',
+        'properties': {
+            'title': f'Catchment above {point}',
+            'outlet_lat': lat,
+            'outlet_lon': lon
+        },
+        'geometry': geometry,
+    }
+    return feature
 
-    region = region or get_region(lon, lat)
-    fname = filename_tpl.format(region=region, data='dir', res=res, ext='tif')
-    fpath = f'{data_dir}/{fname}'
-    grid = Grid.from_raster(fpath)
-    fdir = grid.read_raster(fpath)
-    catchment = grid.catchment(lon, lat, fdir, snap='center')
-    grid.clip_to(catchment)
-    catch_view = grid.view(catchment, dtype=np.uint8)
-    shapes = grid.polygonize(catch_view)
 
-    result = shapes_to_geojson(lon, lat, shapes, region=region, remove_sinks=remove_sinks)
+def delineate_subcatchments(points, res=30, region=None, remove_sinks=False, start=0, stop=None):
+    """
+    Delineate the subcatchments of many outlets in one region at once.
 
-    return result
+    All outlets are labelled in a single upstream pass (see `app.lib.tracing.trace_catchments`) and the label raster
+    is polygonized once, so the cost is about that of delineating the largest catchment on its own.
+
+    Given `start` and `stop`, only the subcatchments of `points[start:stop]` are delineated, still split by all the
+    other outlets, so a large batch can be delineated (and returned) a slice at a time.
 
+    :param points: List of (lon, lat) outlets
+    :return: List of subcatchment features, in the order of `points[start:stop]`
+    """
+    region = region or get_region(*points[0])
+    stop = len(points) if stop is None else min(stop, len(points))
+    _, fdir = get_grid(region, res)
+    grid, labels = trace_catchments(fdir, points, start=start, stop=stop)
 
-def delineations_to_subcatchments(delineations):
-    catchments = {}
-    for d in delineations:
-        props = d['properties']
-        if 'outlet_coords' in props:
-            coords = tuple(d['properties']['outlet_coords'])
-        else:
-            coords = (props['outlet_lon'], props['outlet_lat'])
-        geom = shapely.from_geojson(json.dumps(d))
-        catchments[coords] = geom
-
-    catchment_combos = list(combinations(catchments.keys(), 2))
-    for i, (p1, p2) in enumerate(catchment_combos):
-        c1 = catchments[p1]
-        c2 = catchments[p2]
-
-        # the core algorithm
-        if shapely.contains_xy(c1, *p2):
-            catchments[p1] = shapely.difference(c1, c2)
-        elif shapely.contains_xy(c2, *p1):
-            catchments[p2] = shapely.difference(c2, c1)
+    # keep the largest polygon of each label
+    geometries = {}
+    areas = {}
+    traced = (labels > start) & (labels <= stop)
+    shapes = rasterio.features.shapes(labels, mask=traced, connectivity=4, transform=grid.affine)
+    for geometry, value in shapes:
+        label = int(value)
+        area = shapely.area(shapely.geometry.shape(geometry))
+        if area > areas.get(label, 0):
+            geometries[label] = geometry
+            areas[label] = area
 
     features = []
-    for point, geom in catchments.items():
-        geom_type = geom.geom_type
-        if geom_type == 'Polygon':
-            geometry = geom
-        elif geom_type in ['MultiPolygon', 'GeometryCollection']:
-            area_threshold = 1e-6  # TODO: confirm this threshold
-            geometries = [g for g in geom.geoms if g.area >= area_threshold]
-            geometry = geometries[0]  # TODO: confirm
-        else:
-            raise Exception(f'Unsupported geometry: {geom_type}')
-
-        lon, lat = point
-        feature = {
-            'type': 'Feature',
-            'properties': {
-                'title': f'Catchment above {point}',
-                'outlet_lat': lat,
-                'outlet_lon': lon
-            },
-            'geometry': json.loads(shapely.to_geojson(geometry)),
-        }
+    for label, point in enumerate(points[start:stop], start=start + 1):
+        geometry = geometries.get(label, {'type': 'Polygon', 'coordinates': []})
+        if remove_sinks and geometry['coordinates']:
+            geometry.update(
+                coordinates=[geometry['coordinates'][0]]
+            )
+        features.append(subcatchment_feature(point, geometry))
 
-        features.append(feature)
+    return features
 
-    geojson = {
-        'type': 'FeatureCollection',
-        'features': features,
-    }
 
-    return geojson
+def unique_points(features):
+    return list(dict.fromkeys(tuple(feature['geometry']['coordinates']) for feature in features))
 
 
-def delineate_points(features, res=30):
-    delineations = []
-    for feature in features:
-        # delineation = _delineate_point(feature, res=res)
-        lon, lat = feature['geometry']['coordinates']
-        region = get_region(lon, lat)
-        catchment = delineate_point(lon, lat, res=res, region=region)
-        delineations.append(catchment)
+def group_points(features):
+    """
+    Collect the distinct outlets of a batch, grouped by region so each grid is traced once.
 
-    # step 2: convert to subcatchments
-    catchments = delineations_to_subcatchments(delineations)
+    :param features: List of GeoJSON point features
+    :return: Dict of region to list of (lon, lat) outlets, in the order they first appear
+    """
+    points = unique_points(features)
+    groups = {}
+    for point, region in zip(points, get_regions_bulk(*np.array(points).reshape(-1, 2).T)):
+        if region is None:
+            raise Exception(f'No region found for {point}')
+        groups.setdefault(region, []).append(point)
 
-    return catchments
+    return groups
+
+
+def iter_subcatchments(features, res=30, remove_sinks=False):
+    """
+    Delineate subcatchments region by region, yielding (outlet, feature) pairs as each region is done.
+    """
+    for region, points in group_points(features).items():
+        region_features = delineate_subcatchments(points, res=res, region=region, remove_sinks=remove_sinks)
+        yield from zip(points, region_features)
+
+
+def delineate_points(features, res=30, remove_sinks=False):
+    subcatchments = dict(iter_subcatchments(features, res=res, remove_sinks=remove_sinks))
+
+    geojson = {
+        'type': 'FeatureCollection',
+        'features': [subcatchments[point] for point in unique_points(features)],
+    }
+
+    return geojson
@@ -0,0 +1,216 @@
+import os
+import mmap
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pyproj
+import rasterio
+from affine import Affine
+from pysheds.grid import Grid
+from pysheds.sview import Raster, ViewFinder
+
+import dotenv
+
+dotenv.load_dotenv()
+
+data_dir = os.environ.get('DATA_DIR', './instance/data')
+filename_tpl = 'hyd_{region}_{data}_{res}s.{ext}'
+
+# memory budget for decoded flow direction grids held by a single process
+grid_cache_max_mb = float(os.environ.get('GRID_CACHE_MAX_MB', 6144))
+
+
+def get_memmap_paths(region, res, data='dir'):
+    """
+    Get the paths to the raw array file and its metadata sidecar for a memory-mappable grid.
+    """
+    array_path = f'{data_dir}/' + filename_tpl.format(region=region, data=data, res=res, ext='dat')
+    meta_path = f'{data_dir}/' + filename_tpl.format(region=region, data=data, res=res, ext='json')
+    return array_path, meta_path
+
+
+def open_memmap(array_path, meta_path):
+    """
+    Open a raw array file read-only with np.memmap, using the dtype and shape from its sidecar.
+
+    :return: (np.memmap, dict) tuple of the array and its metadata
+    """
+    with open(meta_path) as f:
+        meta = json.load(f)
+
+    data = np.memmap(array_path, dtype=np.dtype(meta['dtype']), mode='r', shape=tuple(meta['shape']))
+    return data, meta
+
+
+def open_memmap_raster(array_path, meta_path):
+    """
+    Open a raw array file as a read-only, memory-mapped Raster.
+
+    The array is not read into memory; pages are loaded on demand by the OS and shared between all processes that
+    map the same file.
+    """
+    data, meta = open_memmap(array_path, meta_path)
+    shape = data.shape
+    dtype = data.dtype
+
+    viewfinder = ViewFinder(
+        affine=Affine(*meta['affine'][:6]),
+        shape=shape,
+        # a broadcast mask avoids allocating a full-size boolean array
+        mask=np.broadcast_to(np.True_, shape),
+        nodata=dtype.type(meta['nodata'] if meta['nodata'] is not None else 0),
+        crs=pyproj.Proj(meta['crs'], preserve_units=True),
+    )
+
+    return Raster(data, viewfinder=viewfinder)
+
+
+def is_memmapped(array):
+    while array is not None:
+        if isinstance(array, np.memmap):
+            return True
+        array = getattr(array, 'base', None)
+    return False
+
+
+def touch_pages(array, block_bytes=1 << 28):
+    """
+    Read through a memory-mapped array, one byte per page, so the OS loads it into the page cache now rather than on
+    first use. Arrays held in memory are left alone.
+    """
+    if not is_memmapped(array):
+        return
+    data = np.asarray(array).reshape(-1).view(np.uint8)
+    for start in range(0, data.size, block_bytes):
+        data[start:start + block_bytes:mmap.PAGESIZE].max()
+
+
+class GridRegistry(object):
+    """
+    Process-level registry of flow direction rasters, keyed by (region, res).
+
+    Each raster is read from disk once and kept in memory until it is evicted. Eviction is least-recently-used
+    and kicks in when the total size of the loaded rasters exceeds `max_bytes`. Rasters that are memory-mapped (see
+    `app.setup.convert_to_memmap`) live in the OS page cache rather than in the process, so they don't count
+    against the budget. Callers get a fresh `Grid` for every request (so `clip_to` and friends don't leak between
+    requests), which shares the cached raster rather than copying it.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self._rasters = OrderedDict()
+        self._metas = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def __contains__(self, key):
+        return key in self._rasters
+
+    def __len__(self):
+        return len(self._rasters)
+
+    @property
+    def nbytes(self):
+        return sum(raster.nbytes for raster in self._rasters.values() if not is_memmapped(raster))
+
+    def get(self, region, res):
+        """
+        Get a grid and flow direction raster for a region and resolution, loading the raster if needed.
+
+        :param region: HydroSHEDS region code (e.g., 'na')
+        :param res: Resolution, in arc seconds
+        :return: (Grid, Raster) tuple
+        """
+        fdir = self.get_raster(region, res)
+        grid = Grid(viewfinder=fdir.viewfinder)
+        return grid, fdir
+
+    def get_raster(self, region, res):
+        key = (region, res)
+
+        with self._lock:
+            if key in self._rasters:
+                self._rasters.move_to_end(key)
+                return self._rasters[key]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # only one thread loads a given raster; others wait for it
+        with key_lock:
+            with self._lock:
+                if key in self._rasters:
+                    self._rasters.move_to_end(key)
+                    return self._rasters[key]
+
+            fdir = self.load(region, res)
+            fdir.flags.writeable = False
+
+            with self._lock:
+                self._rasters[key] = fdir
+                self._evict(keep=key)
+
+        return fdir
+
+    def get_meta(self, region, res):
+        """
+        Get the shape and affine transform of a flow direction grid without opening it, from its memory-mappable
+        array's sidecar or else the GeoTIFF's header.
+
+        :return: Dict with 'shape' and 'affine' (as a list of six coefficients)
+        """
+        key = (region, res)
+        meta = self._metas.get(key)
+        if meta is None:
+            _, meta_path = get_memmap_paths(region, res)
+            if os.path.exists(meta_path):
+                with open(meta_path) as f:
+                    meta = json.load(f)
+            else:
+                fname = filename_tpl.format(region=region, data='dir', res=res, ext='tif')
+                with rasterio.open(f'{data_dir}/{fname}') as dataset:
+                    meta = {'shape': (dataset.height, dataset.width), 'affine': list(dataset.transform)[:6]}
+            self._metas[key] = meta
+        return meta
+
+    def load(self, region, res):
+        array_path, meta_path = get_memmap_paths(region, res)
+        if os.path.exists(array_path) and os.path.exists(meta_path):
+            logging.info(f'Mapping {array_path}')
+            return open_memmap_raster(array_path, meta_path)
+
+        # fall back to decoding the GeoTIFF
+        fname = filename_tpl.format(region=region, data='dir', res=res, ext='tif')
+        fpath = f'{data_dir}/{fname}'
+        logging.info(f'Loading {fname}')
+        grid = Grid.from_raster(fpath)
+        return grid.read_raster(fpath)
+
+    def evict(self, region, res):
+        with self._lock:
+            self._rasters.pop((region, res), None)
+
+    def clear(self):
+        with self._lock:
+            self._rasters.clear()
+            self._metas.clear()
+
+    def _evict(self, keep=None):
+        if self.max_bytes is None:
+            return
+        while self.nbytes > self.max_bytes and len(self._rasters) > 1:
+            key = next(iter(self._rasters))
+            if key == keep:
+                break
+            logging.info(f'Evicting grid {key}')
+            self._rasters.pop(key)
+        if self.nbytes > self.max_bytes:
+            logging.warning(f'Grid cache exceeds its budget of {self.max_bytes} bytes')
+
+
+grids = GridRegistry(max_bytes=int(grid_cache_max_mb * 1024 * 1024))
+
+
+def get_grid(region, res):
+    return grids.get(region, res)
@@ -0,0 +1,229 @@
+import os
+import threading
+
+import numpy as np
+from numba import njit
+from affine import Affine
+from pysheds.grid import Grid
+from pysheds.sview import Raster, ViewFinder
+
+from app.lib.grids import get_memmap_paths, open_memmap
+from app.lib.tracing import outlet_cell, _row_offsets, _col_offsets, _is_direction
+
+# arrays making up an upstream index, by the `data` part of their file names:
+# pre: position of each cell in a preorder traversal of the drainage network, from outlets up
+# ups: number of cells upstream of (and including) each cell
+# ord: flat cell indices, in preorder
+index_arrays = ['pre', 'ups', 'ord']
+
+
+def index_dtype(shape):
+    return np.dtype(np.uint32 if shape[0] * shape[1] < 2 ** 32 - 1 else np.uint64)
+
+
+@njit(cache=True)
+def _topological_order(fdir, row_offsets, col_offsets, is_direction, topo):
+    nrows, ncols = fdir.shape
+    indegree = np.zeros(nrows * ncols, dtype=np.uint8)
+
+    # the rim is never routed through (as in pysheds), so rim cells have no downstream cell
+    for row in range(1, nrows - 1):
+        for col in range(1, ncols - 1):
+            d = fdir[row, col]
+            if is_direction[d]:
+                indegree[(row + row_offsets[d]) * ncols + col + col_offsets[d]] += 1
+
+    tail = 0
+    for i in range(nrows * ncols):
+        if indegree[i] == 0:
+            topo[tail] = i
+            tail += 1
+
+    head = 0
+    while head < tail:
+        i = topo[head]
+        head += 1
+        row, col = i // ncols, i % ncols
+        if row == 0 or col == 0 or row == nrows - 1 or col == ncols - 1:
+            continue
+        d = fdir[row, col]
+        if is_direction[d]:
+            j = (row + row_offsets[d]) * ncols + col + col_offsets[d]
+            indegree[j] -= 1
+            if indegree[j] == 0:
+                topo[tail] = j
+                tail += 1
+
+    # cells in flow direction loops never reach zero indegree and are left out
+    return tail
+
+
+@njit(cache=True)
+def _nested_intervals(fdir, row_offsets, col_offsets, is_direction, topo, n, unset, pre, ups, order):
+    nrows, ncols = fdir.shape
+
+    # upstream cell counts, from headwaters down
+    for k in range(n):
+        ups[topo[k]] = 1
+    for k in range(n):
+        i = topo[k]
+        row, col = i // ncols, i % ncols
+        if row == 0 or col == 0 or row == nrows - 1 or col == ncols - 1:
+            continue
+        d = fdir[row, col]
+        if is_direction[d]:
+            ups[(row + row_offsets[d]) * ncols + col + col_offsets[d]] += ups[i]
+
+    # preorder positions, from outlets up. Each cell's upstream cells take the positions right after it, so while
+    # cells are being placed `pre` holds the next free position above each cell.
+    next_root = 0
+    for k in range(n - 1, -1, -1):
+        i = topo[k]
+        row, col = i // ncols, i % ncols
+        d = fdir[row, col]
+        j = -1
+        if not (row == 0 or col == 0 or row == nrows - 1 or col == ncols - 1) and is_direction[d]:
+            j = (row + row_offsets[d]) * ncols + col + col_offsets[d]
+            if pre[j] == unset:
+                j = -1
+        if j == -1:
+            position = next_root
+            next_root += ups[i]
+        else:
+            position = pre[j]
+            pre[j] += ups[i]
+        pre[i] = position + 1
+        order[position] = i
+
+    for k in range(n):
+        pre[order[k]] = k
+
+
+def build_upstream_index(fdir, pre, ups, order):
+    """
+    Build a nested interval index of the drainage network defined by a D8 flow direction grid.
+
+    Every cell is numbered by its position in a preorder traversal of the network, starting from outlets and moving
+    upstream, so that the cells upstream of any cell occupy a contiguous range of positions right after it. Finding
+    a catchment is then a slice of `order`, and checking whether one cell is upstream of another is a comparison of
+    their positions.
+
+    :param fdir: Flow direction array (HydroSHEDS D8 encoding)
+    :param pre: Output array, the size of `fdir`, for each cell's position (see `index_dtype`)
+    :param ups: Output array, the size of `fdir`, for each cell's number of upstream cells, including itself
+    :param order: Output array, the size of `fdir`, for flat cell indices in preorder
+    :return: Number of cells indexed
+    """
+    fdir = np.asarray(fdir)
+    if fdir.dtype != np.uint8:
+        fdir = np.where((fdir >= 0) & (fdir < 256), fdir, 0).astype(np.uint8)
+    topo = np.empty(fdir.size, dtype=pre.dtype)
+    n = _topological_order(fdir, _row_offsets, _col_offsets, _is_direction, topo)
+    unset = np.iinfo(pre.dtype).max
+    pre[:] = unset
+    ups[:] = 0
+    _nested_intervals(fdir, _row_offsets, _col_offsets, _is_direction, topo, n, unset, pre, ups, order)
+    return n
+
+
+class UpstreamIndex(object):
+    """
+    Read-only, memory-mapped nested interval index for one region and resolution (see `build_upstream_index`).
+    """
+
+    def __init__(self, pre, ups, order, meta):
+        self.pre = pre
+        self.ups = ups
+        self.order = order
+        self.shape = tuple(meta['shape'])
+        self.affine = Affine(*meta['affine'][:6])
+        self.crs = meta['crs']
+        self.unset = np.iinfo(pre.dtype).max
+
+    @classmethod
+    def open(cls, region, res):
+        arrays = []
+        for data in index_arrays:
+            array_path, meta_path = get_memmap_paths(region, res, data=data)
+            if not (os.path.exists(array_path) and os.path.exists(meta_path)):
+                return None
+            array, meta = open_memmap(array_path, meta_path)
+            arrays.append(array.reshape(-1))
+        return cls(*arrays, meta)
+
+    def position(self, row, col):
+        position = self.pre[row * self.shape[1] + col]
+        return None if position == self.unset else int(position)
+
+    def is_upstream(self, cell, outlet):
+        """
+        Check if `cell` is upstream of (or is) `outlet`, both given as (row, col).
+        """
+        i = cell[0] * self.shape[1] + cell[1]
+        j = outlet[0] * self.shape[1] + outlet[1]
+        pre_i, pre_j = self.pre[i], self.pre[j]
+        return bool(pre_i != self.unset and pre_j <= pre_i < pre_j + self.ups[j])
+
+    def upstream_cells(self, row, col):
+        """
+        Get the flat indices of all cells upstream of (and including) a cell.
+        """
+        position = self.position(row, col)
+        if position is None:
+            return None
+        return self.order[position:position + int(self.ups[row * self.shape[1] + col])]
+
+    def trace(self, fdir, lon, lat):
+        """
+        Delineate the catchment above a point, as a drop-in replacement for `app.lib.tracing.trace_catchment`.
+
+        :return: (Grid, Raster) tuple of a grid viewing the catchment's bounding box and the catchment within it, or
+            None if the outlet is not indexed
+        """
+        row, col = outlet_cell(fdir, lon, lat)
+        cells = self.upstream_cells(row, col)
+        if cells is None:
+            return None
+
+        catch, affine = self.rasterize(cells, fdir.affine)
+        viewfinder = ViewFinder(
+            affine=affine,
+            shape=catch.shape,
+            nodata=False,
+            crs=fdir.crs,
+        )
+        catch = Raster(catch, viewfinder=viewfinder)
+        return Grid(viewfinder=viewfinder), catch
+
+    def rasterize(self, cells, affine=None):
+        """
+        Make a boolean raster of a set of cells, cropped to their bounding box.
+
+        :param cells: Flat cell indices
+        :param affine: Transform of the grid (by default, the index's)
+        :return: (mask, affine) tuple of the raster and its transform
+        """
+        rows, cols = np.divmod(np.asarray(cells, dtype=np.int64), self.shape[1])
+        row0, col0 = rows.min(), cols.min()
+        shape = (int(rows.max() - row0 + 1), int(cols.max() - col0 + 1))
+        mask = np.zeros(shape, dtype=bool)
+        mask[rows - row0, cols - col0] = True
+        return mask, (affine or self.affine) * Affine.translation(int(col0), int(row0))
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_upstream_index(region, res):
+    """
+    Get the upstream index for a region and resolution, or None if it hasn't been built.
+    """
+    key = (region, res)
+    with _indexes_lock:
+        if key not in _indexes:
+            index = UpstreamIndex.open(region, res)
+            if index is None:
+                return None
+            _indexes[key] = index
+        return _indexes[key]
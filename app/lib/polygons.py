@@ -0,0 +1,70 @@
+import json
+
+import numpy as np
+import shapely
+import shapely.geometry
+import rasterio.features
+from affine import Affine
+from scipy.ndimage import binary_fill_holes
+
+
+def crop_to_mask(mask, affine):
+    """
+    Crop a boolean raster to the bounding box of its True cells.
+
+    :return: (mask, affine) tuple of the cropped raster and its transform
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if not len(rows):
+        return mask[:0, :0], affine
+    row0, row1 = rows[0], rows[-1] + 1
+    col0, col1 = cols[0], cols[-1] + 1
+    return mask[row0:row1, col0:col1], affine * Affine.translation(col0, row0)
+
+
+def polygonize(mask, affine, remove_sinks=False, tolerance=0):
+    """
+    Vectorize a catchment mask.
+
+    With `remove_sinks`, holes are filled on the raster first, so each polygon is just its outer ring and no time is
+    spent tracing the rings of sinks only to drop them.
+
+    :param mask: Boolean raster of the catchment
+    :param affine: Transform of the raster
+    :param remove_sinks: Fill holes in the catchment
+    :param tolerance: If given, simplify polygons with this tolerance, in the units of the transform
+    :return: Generator of (GeoJSON geometry, value) tuples, like `rasterio.features.shapes`
+    """
+    mask, affine = crop_to_mask(np.asarray(mask, dtype=bool), affine)
+    if remove_sinks:
+        mask = binary_fill_holes(mask)
+
+    shapes = rasterio.features.shapes(mask.view(np.uint8), mask=mask, connectivity=4, transform=affine)
+    for geometry, value in shapes:
+        if tolerance:
+            polygon = shapely.simplify(shapely.geometry.shape(geometry), tolerance, preserve_topology=True)
+            geometry = shapely.geometry.mapping(polygon)
+        yield geometry, value
+
+
+def simplify_features(features, tolerance=0, precision=None):
+    """
+    Make a lighter copy of GeoJSON features, e.g. for previews, by simplifying and quantizing their geometries.
+
+    :param features: List of GeoJSON features
+    :param tolerance: Simplification tolerance, in degrees (0 for none)
+    :param precision: Decimal places to round coordinates to (None to keep them as they are)
+    :return: List of features with new geometries
+    """
+    if not features:
+        return features
+    geometries = shapely.from_geojson([json.dumps(feature['geometry']) for feature in features])
+    if tolerance:
+        geometries = shapely.simplify(geometries, tolerance, preserve_topology=True)
+    if precision is not None:
+        # snap to the precision grid first, so that rounding can't make polygons invalid
+        geometries = shapely.set_precision(geometries, 10.0 ** -precision)
+        geometries = shapely.transform(geometries, lambda coords: np.round(coords, precision))
+    return [dict(feature, geometry=json.loads(shapely.to_geojson(geometry)))
+            for feature, geometry in zip(features, geometries)]
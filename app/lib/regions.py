@@ -0,0 +1,178 @@
+import os
+import logging
+import threading
+
+import numpy as np
+import shapely
+import rasterio.features
+from rasterio.transform import from_origin
+
+import dotenv
+
+dotenv.load_dotenv()
+
+data_dir = os.environ.get('DATA_DIR', './instance/data')
+
+# all HydroSHEDS regions; a region's position in this list (plus one) is its code in the lookup grid
+region_codes = ['eu', 'as', 'af', 'na', 'sa', 'au']
+
+# cell size, in degrees, of the coarse lon/lat -> region lookup grid
+region_lookup_res = float(os.environ.get('REGION_LOOKUP_RES', 0.1))
+
+
+def get_regions(lon, lat):
+    if 90 < lon < 190 and lat < 8:  # prioritize Australia
+        return ['au', 'as']
+    elif 57 < lon < 155 and 7 < lat < 55:  # prioritize Asia
+        return ['as', 'eu', 'au']
+    elif -30 < lon < 55 and lat < 35:  # prioritize Africa
+        return ['af', 'eu']
+    elif -25 < lon < 70 and 12 < lat:  # prioritize Europe
+        return ['eu', 'af', 'as']
+    elif -82 < lon < -34 and lat < 15:
+        return ['sa', 'na']
+    elif -140 < lon < -52 and 7 < lat < 62:
+        return ['na', 'sa']
+    else:
+        return ['na', 'sa', 'eu', 'af', 'as', 'au']
+
+
+class RegionIndex(object):
+    """
+    Resolves points to HydroSHEDS regions.
+
+    Region masks are parsed once and prepared for fast point-in-polygon tests. In front of them sits a coarse global
+    grid recording, for each cell that lies entirely inside exactly one region, which region that is. Points in such
+    cells, which is almost all of them away from coastlines, are resolved with an array lookup; the rest fall back to
+    the exact masks.
+
+    The lookup grid covers the masks present when it was built. While any are missing (e.g., while data is still being
+    prepared in the background), it is rebuilt as soon as more of them appear.
+    """
+
+    def __init__(self, res=region_lookup_res):
+        self.res = res
+        self.shape = (int(round(180 / res)), int(round(360 / res)))
+        self.transform = from_origin(-180, 90, res, res)
+        self.masks = {}
+        self.lookup = None
+        self.lookup_regions = ()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_mask_path(region):
+        return f'{data_dir}/hyd_{region}_msk_30s.json'
+
+    def get_mask(self, region):
+        """
+        Get the prepared mask geometry of a region, or None if its mask file is missing.
+        """
+        if region not in self.masks:
+            filename = self.get_mask_path(region)
+            if not os.path.exists(filename):
+                return None
+            with open(filename) as f:
+                gj_str = f.read()
+            gj_geom = shapely.from_geojson(gj_str)
+            shapely.prepare(gj_geom)
+            self.masks[region] = gj_geom
+        return self.masks[region]
+
+    def build_lookup(self):
+        """
+        Build the lookup grid from the region masks present.
+
+        :return: (lookup, regions) tuple of the grid and the regions whose masks it covers
+        """
+        logging.info('Building region lookup grid')
+        lookup = np.zeros(self.shape, dtype=np.uint8)
+        claimed = np.zeros(self.shape, dtype=np.uint8)
+        regions = []
+        for code, region in enumerate(region_codes, start=1):
+            mask = self.get_mask(region)
+            if mask is None:
+                continue
+            regions.append(region)
+            parts = shapely.get_parts(mask)
+            touched = rasterio.features.rasterize(
+                parts, out_shape=self.shape, transform=self.transform, all_touched=True, dtype='uint8')
+            edges = rasterio.features.rasterize(
+                shapely.boundary(parts), out_shape=self.shape, transform=self.transform, all_touched=True,
+                dtype='uint8')
+            interior = (touched == 1) & (edges == 0)
+            lookup[interior] = code
+            claimed[touched == 1] += 1
+
+        # cells touched by more than one region are resolved exactly
+        lookup[claimed > 1] = 0
+        return lookup, tuple(regions)
+
+    def is_lookup_stale(self):
+        if self.lookup is None:
+            return True
+        missing = [region for region in region_codes if region not in self.lookup_regions]
+        return any(os.path.exists(self.get_mask_path(region)) for region in missing)
+
+    def lookup_codes(self, lons, lats):
+        with self._lock:
+            if self.is_lookup_stale():
+                self.lookup, self.lookup_regions = self.build_lookup()
+        rows = np.floor((90 - np.asarray(lats, dtype=float)) / self.res).astype(np.int64)
+        cols = np.floor((np.asarray(lons, dtype=float) + 180) / self.res).astype(np.int64)
+        inside = (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1])
+        codes = np.zeros(rows.shape, dtype=np.uint8)
+        codes[inside] = self.lookup[rows[inside], cols[inside]]
+        return codes
+
+    def get_region(self, lon, lat):
+        code = int(self.lookup_codes([lon], [lat])[0])
+        if code:
+            return region_codes[code - 1]
+
+        for region in get_regions(lon, lat):
+            mask = self.get_mask(region)
+            if mask is not None and shapely.contains_xy(mask, lon, lat):
+                return region
+
+        raise Exception('No region found')
+
+    def get_regions_bulk(self, lons, lats):
+        """
+        Resolve many points to regions at once.
+
+        :return: Array of region codes (e.g., 'na'), with None for points outside all regions
+        """
+        lons = np.asarray(lons, dtype=float).reshape(-1)
+        lats = np.asarray(lats, dtype=float).reshape(-1)
+        codes = self.lookup_codes(lons, lats)
+
+        regions = np.full(lons.shape, None, dtype=object)
+        known = codes > 0
+        regions[known] = np.array(region_codes, dtype=object)[codes[known] - 1]
+
+        # the rest are tested against the masks, in each point's order of candidate regions
+        unknown = np.flatnonzero(~known)
+        candidates = [get_regions(lons[i], lats[i]) for i in unknown]
+        for rank in range(len(region_codes)):
+            for region in region_codes:
+                mask = self.get_mask(region)
+                if mask is None:
+                    continue
+                idx = np.array([i for i, c in zip(unknown, candidates)
+                                if len(c) > rank and c[rank] == region and regions[i] is None], dtype=np.int64)
+                if len(idx):
+                    inside = shapely.contains_xy(mask, lons[idx], lats[idx])
+                    regions[idx[inside]] = region
+
+        return regions
+
+
+region_index = RegionIndex()
+
+
+def get_region(lon, lat):
+    return region_index.get_region(lon, lat)
+
+
+def get_regions_bulk(lons, lats):
+    return region_index.get_regions_bulk(lons, lats)
@@ -0,0 +1,395 @@
+import io
+import os
+import math
+import string
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import shapely.geometry
+import rasterio.features
+from affine import Affine
+from PIL import Image
+
+try:
+    import mapbox_vector_tile
+except ImportError:
+    mapbox_vector_tile = None
+
+from app.lib.grids import get_memmap_paths, open_memmap
+from app.lib.regions import region_codes
+
+import dotenv
+
+dotenv.load_dotenv()
+
+data_dir = os.environ.get('DATA_DIR', './instance/data')
+
+# where the streamline tiles given by /tiles/streamlines come from: 'earthengine', or 'local' to render them from the
+# flow accumulation grids, which are then prepared along with the other data (see `app.setup.initialize`)
+streamline_tiles_source = os.environ.get('STREAMLINE_TILES', 'earthengine')
+
+# rendered tiles are kept on disk (set to an empty string to disable) and, most recently used first, in memory
+tile_cache_dir = os.environ.get('TILE_CACHE_DIR', f'{data_dir}/tiles')
+tile_cache_max_mb = float(os.environ.get('TILE_CACHE_MAX_MB', 64))
+tile_cache_disk_max_mb = float(os.environ.get('TILE_CACHE_DISK_MAX_MB', 1024)) or None
+
+tile_size = 256
+max_zoom = 24
+mvt_extent = 4096
+earth_radius = 6378137
+
+# flow direction of sinks
+sink_value = 255
+
+
+def tile_bounds(z, x, y):
+    """
+    Bounds of a map tile, in Web Mercator meters.
+    """
+    size = 2 * math.pi * earth_radius / 2 ** z
+    minx = -math.pi * earth_radius + x * size
+    maxy = math.pi * earth_radius - y * size
+    return minx, maxy - size, minx + size, maxy
+
+
+def get_stream_threshold(threshold):
+    """
+    Flow accumulation (in cells) above which a cell is drawn as a stream, for a threshold from 0 (only the largest
+    rivers) to 100 (every cell), as for the Earth Engine layers.
+    """
+    return pow(5, (100 - threshold) / 100 * 7.5)
+
+
+def get_overview_factors(shape):
+    """
+    Overview levels of a grid, halving it each time until it fits in a tile.
+    """
+    factors = []
+    factor = 2
+    while max(shape) / factor >= tile_size / 2:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def get_overview_paths(region, res, data, factor):
+    """
+    Paths to an overview of a grid, as a memory-mappable array and its sidecar (see `app.lib.grids.open_memmap`).
+    """
+    return get_memmap_paths(region, res, data=f'{data}_{factor}x')
+
+
+def max_pool(src, dst, prepare=None, block_rows=1024):
+    """
+    Write the maximum of each 2x2 block of cells in a grid to a grid half its size, reading a block of rows at a time.
+
+    :param src: Source grid
+    :param dst: Destination grid, of shape (ceil(rows / 2), ceil(cols / 2))
+    :param prepare: Optional function applied to each block of rows of the source first
+    """
+    rows, cols = src.shape
+    for row in range(0, rows, block_rows):
+        block = np.asarray(src[row:row + block_rows])
+        if prepare is not None:
+            block = prepare(block)
+        padded = np.zeros((block.shape[0] + block.shape[0] % 2, cols + cols % 2), dtype=block.dtype)
+        padded[:block.shape[0], :cols] = block
+        pooled = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2).max(axis=(1, 3))
+        dst[row // 2:row // 2 + pooled.shape[0]] = pooled
+
+
+def normalize_color(color):
+    """
+    Get a color, named or as (optionally #-prefixed) hex, as 6 uppercase hex digits.
+
+    :raises ValueError: If it isn't a known name or 6 hex digits
+    """
+    colors = {'red': 'FF0000', 'blue': '0000FF', 'black': '000000', 'white': 'FFFFFF'}
+    color = colors.get(color, color)
+    if color.startswith('#'):
+        color = color[1:]
+    if len(color) != 6 or not all(c in string.hexdigits for c in color):
+        raise ValueError(f'Invalid color: {color}')
+    return color.upper()
+
+
+def parse_color(color):
+    color = normalize_color(color)
+    return tuple(int(color[i:i + 2], 16) for i in (0, 2, 4)) + (255,)
+
+
+class StreamlineTiles(object):
+    """
+    Renders XYZ tiles of streams (cells whose flow accumulation exceeds a threshold) and sinks from the HydroSHEDS
+    flow accumulation and flow direction grids, memory-mapped like the grids used for delineation.
+
+    Zoomed out, tiles are sampled from overviews built by `app.setup.build_tile_overviews`, which hold the maximum of
+    the cells they cover, so streams and sinks stay visible and no more of a grid is read than a tile shows. Rendered
+    tiles are cached in memory and on disk.
+    """
+
+    def __init__(self, cache_dir=tile_cache_dir, max_bytes=None, max_disk_bytes=None):
+        """
+        :param max_bytes: Size of the tiles kept in memory, beyond which the least recently used are dropped
+        :param max_disk_bytes: Size of the tiles kept on disk, beyond which the least recently used are deleted
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._tiles = OrderedDict()
+        self._nbytes = 0
+        self._disk_bytes = None
+        self._levels = {}
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+
+    def get_tile(self, z, x, y, res=30, threshold=50, showsinks=True, palette='0000FF', sink_color='red',
+                 ext='png'):
+        """
+        Get a tile, rendering it if it isn't cached.
+
+        :param ext: 'png', or 'mvt' for a vector tile with `streams` and `sinks` layers (which ignores the colors)
+        :return: The encoded tile
+        :raises ValueError: If a color is invalid (see `normalize_color`)
+        """
+        if ext == 'mvt':
+            key = f'streamlines/{int(res)}/{int(threshold)}/{int(showsinks)}/{int(z)}/{int(x)}/{int(y)}.mvt'
+        else:
+            palette = normalize_color(palette)
+            sink_color = normalize_color(sink_color)
+            key = (f'streamlines/{int(res)}/{int(threshold)}/{int(showsinks)}/{palette}/{sink_color}/'
+                   f'{int(z)}/{int(x)}/{int(y)}.png')
+        tile = self._get_cached(key)
+        if tile is None:
+            streams, sinks = self.render(z, x, y, res, threshold, showsinks)
+            if ext == 'mvt':
+                tile = self.to_mvt(streams, sinks)
+            else:
+                tile = self.to_png(streams, sinks, palette, sink_color)
+            self._put_cached(key, tile)
+        return tile
+
+    def render(self, z, x, y, res=30, threshold=50, showsinks=True):
+        """
+        Rasterize a tile.
+
+        :return: (streams, sinks) tuple of boolean arrays, one value per tile pixel
+        """
+        lons, lats = self._pixel_centers(z, x, y)
+        min_accumulation = get_stream_threshold(threshold)
+
+        streams = np.zeros((tile_size, tile_size), dtype=bool)
+        sinks = np.zeros((tile_size, tile_size), dtype=bool)
+        for region in region_codes:
+            sampled = self._sample(self.get_levels(region, res, 'acc'), lons, lats)
+            if sampled is not None:
+                values, inside, factor, nodata = sampled
+                if factor == 1 and nodata is not None:
+                    inside &= values != nodata
+                streams |= inside & (values >= min_accumulation)
+            if showsinks:
+                sampled = self._sample(self.get_levels(region, res, 'snk'), lons, lats)
+                if sampled is not None:
+                    values, inside, factor, _ = sampled
+                    # the full resolution level is the flow direction grid itself
+                    sinks |= inside & (values == sink_value if factor == 1 else values > 0)
+
+        return streams, sinks
+
+    def get_levels(self, region, res, data):
+        """
+        Get a grid and its overviews, from the most to the least detailed.
+
+        :param data: 'acc' for flow accumulation, or 'snk' for sinks (whose full resolution level is the flow
+            direction grid)
+        :return: List of (factor, array, metadata) tuples, empty if the grid is missing
+        """
+        key = (region, res, data)
+        with self._lock:
+            if key in self._levels:
+                return self._levels[key]
+
+        levels = []
+        array_path, meta_path = get_memmap_paths(region, res, data='dir' if data == 'snk' else data)
+        if os.path.exists(array_path) and os.path.exists(meta_path):
+            levels.append((1,) + open_memmap(array_path, meta_path))
+            for factor in get_overview_factors(levels[0][1].shape):
+                overview_path, overview_meta_path = get_overview_paths(region, res, data, factor)
+                if not os.path.exists(overview_path) or not os.path.exists(overview_meta_path):
+                    break
+                levels.append((factor,) + open_memmap(overview_path, overview_meta_path))
+
+        with self._lock:
+            self._levels[key] = levels
+        return levels
+
+    @staticmethod
+    def to_png(streams, sinks, palette='0000FF', sink_color='red'):
+        rgba = np.zeros((tile_size, tile_size, 4), dtype=np.uint8)
+        rgba[streams] = parse_color(palette)
+        rgba[sinks] = parse_color(sink_color)
+        buffer = io.BytesIO()
+        Image.fromarray(rgba, 'RGBA').save(buffer, format='PNG')
+        return buffer.getvalue()
+
+    @staticmethod
+    def to_mvt(streams, sinks):
+        if mapbox_vector_tile is None:
+            raise Exception('Vector tiles require mapbox-vector-tile')
+        transform = Affine.scale(mvt_extent / tile_size)
+        layers = []
+        for name, mask in [('streams', streams), ('sinks', sinks)]:
+            shapes = rasterio.features.shapes(mask.view(np.uint8), mask=mask, transform=transform)
+            features = [{'geometry': shapely.geometry.shape(geometry), 'properties': {}} for geometry, _ in shapes]
+            layers.append({'name': name, 'features': features})
+        return mapbox_vector_tile.encode(layers, default_options={'y_coord_down': True, 'extents': mvt_extent})
+
+    @staticmethod
+    def _pixel_centers(z, x, y):
+        minx, miny, maxx, maxy = tile_bounds(z, x, y)
+        offsets = (np.arange(tile_size) + 0.5) / tile_size
+        xs = minx + offsets * (maxx - minx)
+        ys = maxy - offsets * (maxy - miny)
+        lons = np.degrees(xs / earth_radius)
+        lats = np.degrees(2 * np.arctan(np.exp(ys / earth_radius)) - np.pi / 2)
+        return lons, lats
+
+    @staticmethod
+    def _sample(levels, lons, lats):
+        """
+        Sample a grid at the centers of a tile's pixels, from the least detailed level that still resolves them.
+
+        :return: (values, inside, factor, nodata) tuple of the sampled values, where the tile overlaps the grid, the
+            level's factor and the grid's nodata value; or None if the tile doesn't overlap the grid
+        """
+        if not levels:
+            return None
+
+        pixel_size = (lons[-1] - lons[0]) / (tile_size - 1)
+        factor, array, meta = levels[0]
+        for level in levels[1:]:
+            if abs(level[2]['affine'][0]) > pixel_size:
+                break
+            factor, array, meta = level
+
+        a, _, west, _, e, north = meta['affine'][:6]
+        cols = np.floor((lons - west) / a).astype(np.int64)
+        rows = np.floor((lats - north) / e).astype(np.int64)
+        valid_cols = (cols >= 0) & (cols < array.shape[1])
+        valid_rows = (rows >= 0) & (rows < array.shape[0])
+        if not valid_cols.any() or not valid_rows.any():
+            return None
+
+        cells = np.ix_(valid_rows, valid_cols)
+        values = np.zeros((tile_size, tile_size), dtype=array.dtype)
+        values[cells] = array[np.ix_(rows[valid_rows], cols[valid_cols])]
+        inside = np.zeros((tile_size, tile_size), dtype=bool)
+        inside[cells] = True
+        return values, inside, factor, meta.get('nodata')
+
+    def _get_cached(self, key):
+        with self._lock:
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+                return self._tiles[key]
+
+        if self.cache_dir:
+            path = self._cache_path(key)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    tile = f.read()
+                try:
+                    # mark it as recently used, so it's among the last deleted (see `_prune`)
+                    os.utime(path)
+                except OSError:
+                    pass
+                self._remember(key, tile)
+                return tile
+
+        return None
+
+    def _put_cached(self, key, tile):
+        self._remember(key, tile)
+        if self.cache_dir:
+            path = self._cache_path(key)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f'{path}.{threading.get_ident()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(tile)
+                os.replace(tmp_path, path)
+            except OSError as err:
+                logging.warning(f'Could not cache tile {key}: {err}')
+                return
+            self._count_disk_bytes(len(tile))
+
+    def _cache_path(self, key):
+        root = os.path.realpath(self.cache_dir)
+        path = os.path.realpath(os.path.join(root, key))
+        if os.path.commonpath([root, path]) != root:
+            raise ValueError(f'Invalid tile key: {key}')
+        return path
+
+    def _count_disk_bytes(self, nbytes):
+        if self.max_disk_bytes is None:
+            return
+        with self._disk_lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for _, size, _ in self._scan_disk())
+            else:
+                self._disk_bytes += nbytes
+            if self._disk_bytes > self.max_disk_bytes:
+                self._prune()
+
+    def _scan_disk(self):
+        """
+        List the tiles cached on disk, by any process.
+
+        :return: List of (path, size, modification time) tuples
+        """
+        files = []
+        for dirpath, _, fnames in os.walk(self.cache_dir):
+            for fname in fnames:
+                if fname.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, fname)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((path, stat.st_size, stat.st_mtime))
+        return files
+
+    def _prune(self):
+        """
+        Delete the least recently used tiles from disk, until they take up at most 90% of `max_disk_bytes`.
+        """
+        files = sorted(self._scan_disk(), key=lambda file: file[2])
+        total = sum(size for _, size, _ in files)
+        for path, size, _ in files:
+            if total <= 0.9 * self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._disk_bytes = total
+
+    def _remember(self, key, tile):
+        with self._lock:
+            if key in self._tiles:
+                return
+            self._tiles[key] = tile
+            self._nbytes += len(tile)
+            while self.max_bytes is not None and self._nbytes > self.max_bytes and len(self._tiles) > 1:
+                _, evicted = self._tiles.popitem(last=False)
+                self._nbytes -= len(evicted)
+
+
+streamline_tiles = StreamlineTiles(
+    max_bytes=int(tile_cache_max_mb * 1024 * 1024),
+    max_disk_bytes=int(tile_cache_disk_max_mb * 1024 * 1024) if tile_cache_disk_max_mb else None
+)
@@ -0,0 +1,227 @@
+import os
+from math import floor
+
+import numpy as np
+from numba import njit
+from affine import Affine
+from pysheds.grid import Grid
+from pysheds.sview import Raster, ViewFinder
+
+import dotenv
+
+dotenv.load_dotenv()
+
+# initial size, in cells, of the window traced around an outlet
+trace_window = int(os.environ.get('TRACE_WINDOW', 512))
+
+# HydroSHEDS D8 direction values, in pysheds order: N, NE, E, SE, S, SW, W, NW
+dirmap = (64, 128, 1, 2, 4, 8, 16, 32)
+offsets = ((-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1))
+
+_row_offsets = np.zeros(256, dtype=np.int64)
+_col_offsets = np.zeros(256, dtype=np.int64)
+_is_direction = np.zeros(256, dtype=bool)
+for _d, (_dr, _dc) in zip(dirmap, offsets):
+    _row_offsets[_d] = _dr
+    _col_offsets[_d] = _dc
+    _is_direction[_d] = True
+
+# for each neighbor offset, the direction value with which that neighbor drains into the center cell
+_neighbor_rows = np.array([dr for dr, dc in offsets], dtype=np.int64)
+_neighbor_cols = np.array([dc for dr, dc in offsets], dtype=np.int64)
+_inflow_directions = np.array([dirmap[(k + 4) % 8] for k in range(8)], dtype=np.int64)
+
+
+def outlet_cell(fdir, lon, lat):
+    """
+    Get the (row, col) of the cell containing a point, equivalent to pysheds' `nearest_cell` with `snap='center'`.
+    """
+    return cell_at(fdir.affine, fdir.shape, lon, lat)
+
+
+def cell_at(affine, shape, lon, lat):
+    """
+    Get the (row, col) of the cell containing a point, from a grid's affine transform and shape alone (see
+    `outlet_cell`).
+    """
+    col, row = ~affine * (lon, lat)
+    row, col = floor(row), floor(col)
+    nrows, ncols = shape
+    if not (0 <= row < nrows and 0 <= col < ncols):
+        bbox = (affine.c, affine.f + nrows * affine.e, affine.c + ncols * affine.a, affine.f)
+        raise ValueError(f'Pour point ({lon}, {lat}) is out of bounds for dataset with bbox {bbox}.')
+    return row, col
+
+
+def window_raster(fdir, row0, row1, col0, col1):
+    """
+    Get a window of a flow direction raster as a Raster of its own, without copying the underlying array.
+    """
+    data = fdir[row0:row1, col0:col1]
+    shape = data.shape
+    viewfinder = ViewFinder(
+        affine=fdir.affine * Affine.translation(col0, row0),
+        shape=shape,
+        mask=np.broadcast_to(np.True_, shape),
+        nodata=fdir.nodata,
+        crs=fdir.crs,
+    )
+    return Raster(np.asarray(data), viewfinder=viewfinder)
+
+
+def _rim_inflow(window, catch):
+    """
+    Find which sides of a window have rim cells that drain into a traced catchment.
+
+    pysheds never routes through the outermost ring of cells, so if any of those cells drains into the catchment,
+    part of the catchment lies outside the window.
+
+    :return: (top, bottom, left, right) booleans
+    """
+    nrows, ncols = window.shape
+    sides = []
+    for rows, cols in [
+        (np.zeros(ncols, dtype=np.int64), np.arange(ncols)),
+        (np.full(ncols, nrows - 1), np.arange(ncols)),
+        (np.arange(nrows), np.zeros(nrows, dtype=np.int64)),
+        (np.arange(nrows), np.full(nrows, ncols - 1)),
+    ]:
+        values = np.asarray(window)[rows, cols].astype(np.int64) & 0xff
+        valid = _is_direction[values]
+        to_rows = rows[valid] + _row_offsets[values[valid]]
+        to_cols = cols[valid] + _col_offsets[values[valid]]
+        inside = (to_rows >= 0) & (to_rows < nrows) & (to_cols >= 0) & (to_cols < ncols)
+        sides.append(bool(np.asarray(catch)[to_rows[inside], to_cols[inside]].any()))
+    return tuple(sides)
+
+
+def trace_catchment(fdir, lon, lat, window=None):
+    """
+    Delineate the catchment above a point, reading only as much of the flow direction raster as needed.
+
+    Tracing starts in a small window around the outlet. The window grows, on the sides where cells outside it drain
+    into the catchment, until the catchment is complete. The result is identical to tracing over the whole raster,
+    but the work done scales with the size of the catchment rather than the size of the raster.
+
+    :param fdir: Flow direction Raster (ideally memory-mapped)
+    :param lon: Outlet longitude
+    :param lat: Outlet latitude
+    :param window: Initial window size, in cells
+    :return: (Grid, Raster) tuple of a grid viewing the final window and the catchment within it
+    """
+    window = window or trace_window
+    nrows, ncols = fdir.shape
+    row, col = outlet_cell(fdir, lon, lat)
+
+    half = window // 2
+    row0, row1 = max(row - half, 0), min(row + half + 1, nrows)
+    col0, col1 = max(col - half, 0), min(col + half + 1, ncols)
+
+    while True:
+        sub = window_raster(fdir, row0, row1, col0, col1)
+        grid = Grid(viewfinder=sub.viewfinder)
+        catch = grid.catchment(col - col0, row - row0, sub, xytype='index')
+
+        top, bottom, left, right = _rim_inflow(sub, catch)
+        # the rim of the full raster is never routed through, so there is nothing to grow into there
+        top, bottom = top and row0 > 0, bottom and row1 < nrows
+        left, right = left and col0 > 0, right and col1 < ncols
+        if not (top or bottom or left or right):
+            return grid, catch
+
+        row0, row1, col0, col1 = _grow_window(row0, row1, col0, col1, (top, bottom, left, right), fdir.shape)
+
+
+def _grow_window(row0, row1, col0, col1, sides, shape):
+    top, bottom, left, right = sides
+    nrows, ncols = shape
+    height, width = row1 - row0, col1 - col0
+    if top:
+        row0 = max(row0 - height, 0)
+    if bottom:
+        row1 = min(row1 + height, nrows)
+    if left:
+        col0 = max(col0 - width, 0)
+    if right:
+        col1 = min(col1 + width, ncols)
+    return row0, row1, col0, col1
+
+
+@njit(cache=True)
+def _label_upstream(fdir, rows, cols, start, stop, labels, neighbor_rows, neighbor_cols, inflow_directions):
+    nrows, ncols = fdir.shape
+
+    # outlets are labelled first, so that tracing up from one outlet stops at the next outlet upstream
+    for i in range(len(rows)):
+        if 0 <= rows[i] < nrows and 0 <= cols[i] < ncols:
+            labels[rows[i], cols[i]] = i + 1
+
+    # a stack of cells still to visit, grown as needed rather than sized for the whole window
+    stack = np.empty(4096, dtype=np.int64)
+    for i in range(start, stop):
+        label = i + 1
+        if labels[rows[i], cols[i]] != label:
+            continue  # another outlet in the same cell
+        stack[0] = rows[i] * ncols + cols[i]
+        top = 1
+        while top > 0:
+            top -= 1
+            row, col = stack[top] // ncols, stack[top] % ncols
+            for k in range(8):
+                r, c = row + neighbor_rows[k], col + neighbor_cols[k]
+                # the rim is never routed through, as in pysheds
+                if r < 1 or c < 1 or r >= nrows - 1 or c >= ncols - 1:
+                    continue
+                if labels[r, c] == 0 and fdir[r, c] == inflow_directions[k]:
+                    labels[r, c] = label
+                    if top == len(stack):
+                        grown = np.empty(2 * len(stack), dtype=np.int64)
+                        grown[:top] = stack
+                        stack = grown
+                    stack[top] = r * ncols + c
+                    top += 1
+
+
+def trace_catchments(fdir, points, window=None, start=0, stop=None):
+    """
+    Delineate the subcatchments of many outlets in a single pass.
+
+    Every cell is labelled with the (1-based) position in `points` of the first outlet downstream of it, so nested
+    outlets split the catchment of the outlet below them. Each cell is visited once, regardless of how many outlets
+    drain through it. As with `trace_catchment`, tracing starts in a window around the outlets and grows it until
+    no cells outside the window drain into a labelled cell.
+
+    Only the subcatchments of `points[start:stop]` are traced; the other outlets still split them, so tracing
+    consecutive slices gives the same subcatchments as tracing all at once.
+
+    :param fdir: Flow direction Raster (ideally memory-mapped)
+    :param points: List of (lon, lat) outlets
+    :param window: Padding, in cells, of the initial window around the outlets
+    :param start: Position in `points` of the first outlet to trace
+    :param stop: Position in `points` after the last outlet to trace
+    :return: (Grid, ndarray) tuple of a grid viewing the final window and the labels within it; cells labelled
+        outside (start, stop] are other outlets
+    """
+    window = window or trace_window
+    stop = len(points) if stop is None else min(stop, len(points))
+    nrows, ncols = fdir.shape
+    cells = np.array([outlet_cell(fdir, lon, lat) for lon, lat in points], dtype=np.int64).reshape(-1, 2)
+    rows, cols = cells[:, 0], cells[:, 1]
+
+    half = window // 2
+    row0, row1 = max(rows[start:stop].min() - half, 0), min(rows[start:stop].max() + half + 1, nrows)
+    col0, col1 = max(cols[start:stop].min() - half, 0), min(cols[start:stop].max() + half + 1, ncols)
+
+    while True:
+        sub = window_raster(fdir, row0, row1, col0, col1)
+        labels = np.zeros(sub.shape, dtype=np.int32)
+        _label_upstream(np.asarray(sub), rows - row0, cols - col0, start, stop, labels,
+                        _neighbor_rows, _neighbor_cols, _inflow_directions)
+
+        top, bottom, left, right = _rim_inflow(sub, (labels > start) & (labels <= stop))
+        top, bottom = top and row0 > 0, bottom and row1 < nrows
+        left, right = left and col0 > 0, right and col1 < ncols
+        if not (top or bottom or left or right):
+            return Grid(viewfinder=sub.viewfinder), labels
+
+        row0, row1, col0, col1 = _grow_window(row0, row1, col0, col1, (top, bottom, left, right), fdir.shape)
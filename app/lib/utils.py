@@ -1,5 +1,13 @@
+import os
 from math import floor
 
+import dotenv
+
+dotenv.load_dotenv()
+
+# bump to invalidate every cached catchment, e.g. after a change to how catchments are delineated
+cache_version = os.environ.get('CACHE_VERSION', '1')
+
 
 def snap_to_center(n, res):
     r = res / 60 / 60
@@ -10,4 +18,18 @@ def snap_to_center(n, res):
 def make_catchment_key(lon, lat, res, routing='d8', remove_sinks=True):
     lon = snap_to_center(lon, res)
     lat = snap_to_center(lat, res)
-    return f'{lon}:{lat}:{routing}:{res}:{remove_sinks}'
+    return f'v{cache_version}:{lon}:{lat}:{routing}:{res}:{remove_sinks}'
+
+
+def make_cell_key(region, res, row, col, routing='d8', remove_sinks=True):
+    """
+    Key of the catchment above a grid cell, so that all outlets in the cell share it.
+    """
+    return f'v{cache_version}:{region}:{row}:{col}:{routing}:{res}:{remove_sinks}'
+
+
+def make_detail_key(key, tolerance=0, precision=None):
+    """
+    Key of a simplified (lower detail) version of a cached result.
+    """
+    return f'{key}:{tolerance}:{precision}'
@@ -1,17 +1,33 @@
 import os
-import json
+import asyncio
 import logging
+import threading
+from urllib.parse import urlencode
 
-from fastapi import FastAPI, Security, HTTPException, status
+import orjson
+from fastapi import FastAPI, Request, Response, Security, HTTPException, status
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import APIKeyHeader, APIKeyQuery
 
-from app.setup import initialize
+from app.setup import initialize, warm_up, warm_up_process
 from app.model import Outlets
-from app.store import redis, get_stored_result
+from app.store import encode_result, decode_result, decode_features, to_payload, \
+    get_stored_value_async, store_value_async
+from app.formats import negotiate, encode_features, split_features, UnsupportedFormat
 from app.helpers import EarthEngineMap
-from app.tasks import celery, delineate_point, delineate_from_features
-from app.lib.utils import make_catchment_key
+from app.executor import executor, Saturated
+from app.coalesce import single_flight
+from app.metrics import metrics
+from app.monitor import WorkerMonitor
+from app.cells import locate_cell, delineate_cell
+from app.jobs import create_job, finish_job, get_job, get_job_results
+from app.tasks import celery, delineate_point, delineate_features, delineate_job_chunk, submit_job
+from app.lib.delineation import delineate_point as _delineate_point, delineate_points as _delineate_points, \
+    delineate_subcatchments, group_points
+from app.lib.polygons import simplify_features
+from app.lib.utils import make_cell_key, make_detail_key
+from app.lib.tiles import streamline_tiles, streamline_tiles_source, normalize_color, max_zoom
 
 from dotenv import load_dotenv
 
@@ -19,11 +35,20 @@ load_dotenv()
 
 regions = ['eu', 'as', 'af', 'na', 'sa', 'au']
 resolutions = [15, 30]
-initialize(regions, resolutions)
+
+# download missing data when starting, rather than in a separate `python -m app.setup prepare` step
+prepare_on_startup = os.environ.get('PREPARE_ON_STARTUP', '0') == '1'
+
+# grids to load before reporting ready
+warm_regions = os.environ.get('WARM_REGIONS', ','.join(regions)).split(',')
+warm_resolutions = [int(res) for res in os.environ.get('WARM_RESOLUTIONS', '30').split(',')]
+
+# outlets delineated together when streaming batch subcatchments
+stream_chunk_size = int(os.environ.get('STREAM_CHUNK_SIZE', 100))
 
 API_KEYS = [os.environ['API_KEY']]
 
-api_key_header = APIKeyHeader(name='x-api-key')
+api_key_header = APIKeyHeader(name='x-api-key', auto_error=False)
 api_key_query = APIKeyQuery(name="api-key", auto_error=False)
 
 
@@ -47,8 +72,11 @@ def get_api_key(
     )
 
 
+# responses are serialized with orjson; routes returning large results return an ORJSONResponse themselves, which
+# also skips FastAPI's `jsonable_encoder` walk over every coordinate
 app = FastAPI(title='flowdirections.io',
-              description='A catchment delineation API using pysheds + HydroSHEDS')
+              description='A catchment delineation API using pysheds + HydroSHEDS',
+              default_response_class=ORJSONResponse)
 
 deployment_mode = os.environ.get('DEPLOYMENT_MODE', 'development')
 logging.info(f'Deployment mode: {deployment_mode}')
@@ -66,25 +94,226 @@ app.add_middleware(
     allow_headers=['*'],
 )
 
+# public URL of the API, e.g. https://api.flowdirections.io, for links to it (such as local streamline tiles)
+public_url = os.environ.get('PUBLIC_URL')
+
+tile_media_types = {'png': 'image/png', 'mvt': 'application/vnd.mapbox-vector-tile'}
+
 app.ee = EarthEngineMap()
+app.ready = False
+
+worker_monitor = WorkerMonitor(celery)
+
+# delineation processes map the grids warmed up here before taking any work
+executor.initializer = warm_up_process
+executor.initargs = (warm_regions, warm_resolutions)
 
 
 def get_celery_worker_status():
-    i = celery.control.inspect()
-    return i.ping()
+    return worker_monitor.available
+
+
+def prepare_and_warm_up():
+    try:
+        if prepare_on_startup:
+            initialize(regions, resolutions)
+        warm_up(warm_regions, warm_resolutions)
+        executor.start()
+        app.ready = True
+        logging.info('Ready')
+    except Exception:
+        logging.exception('Failed to prepare data')
+
+
+def wait_for_result(result):
+    """
+    Wait for a task's result, and drop it from the result backend once we have it.
+    """
+    try:
+        return result.get()
+    finally:
+        result.forget()
+
+
+def run_task(task, *args, **kwargs):
+    return wait_for_result(task.delay(*args, **kwargs))
+
+
+def run_batch(features, res, remove_sinks):
+    return wait_for_result(delineate_features(features, res=res, remove_sinks=remove_sinks).apply_async())
 
 
-def get_result(key, fn, *args, **kwargs):
-    result = get_stored_result(key)
-    if result:
-        return json.loads(result)
+def stored_response(request, value):
+    body, content_encoding = to_payload(value, request.headers.get('accept-encoding', ''))
+    headers = {'Vary': 'Accept-Encoding'}
+    if content_encoding:
+        headers['Content-Encoding'] = content_encoding
+    return Response(content=body, media_type='application/json', headers=headers)
+
+
+def get_format(request, format=None, tile=None):
+    """
+    Pick the format of a catchment response (see `app.formats.negotiate`), or raise a 406 if it can't be made.
+    """
+    try:
+        name = negotiate(request.headers.get('accept', ''), format)
+    except UnsupportedFormat as err:
+        raise HTTPException(status_code=status.HTTP_406_NOT_ACCEPTABLE, detail=str(err))
+    if name == 'mvt' and (tile is None or None in tile):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Vector tiles need z, x and y')
+    return name
+
+
+async def encoded_response(name, properties, geometries, tile=None):
+    content, media_type = await asyncio.to_thread(encode_features, name, properties, geometries, tile)
+    return Response(content=content, media_type=media_type, headers={'Vary': 'Accept'})
+
+
+async def get_value(key, task, fn, *args, **kwargs):
+    """
+    Get a stored value, or compute and store it, without blocking the event loop.
+
+    The result is computed by a Celery worker if any are up, otherwise locally in the delineation process pool.
+    Concurrent requests for the same uncached key share one computation (see `app.coalesce`).
+    """
+
+    async def compute():
+        with metrics.timer('routing'):
+            workers_available = get_celery_worker_status()
+        with metrics.timer('delineation'):
+            if workers_available:
+                result = await executor.run_in_thread(run_task, task, *args, **kwargs)
+            else:
+                result = await executor.run(fn, *args, **kwargs)
+        computed = encode_result(result)
+        await store_value_async(key, computed)
+        return computed
+
+    with metrics.timer('cache_lookup'):
+        value = await get_stored_value_async(key)
+    if value:
+        metrics.incr('cache_hits')
     else:
-        if get_celery_worker_status():
-            result = fn.delay(*args, **kwargs).get()
-        else:
-            result = fn(*args, **kwargs)
-        redis.set(key, json.dumps(result))
-        return result
+        metrics.incr('cache_misses')
+        value = await single_flight.run(key, compute)
+    return value
+
+
+def simplify_value(value, tolerance, precision):
+    result = decode_result(value)
+    result['features'] = simplify_features(result['features'], tolerance=tolerance, precision=precision)
+    return encode_result(result)
+
+
+async def get_detail_value(key, tolerance, precision, task, fn, *args, **kwargs):
+    """
+    Get a simplified version of a stored value, deriving it from the full one if it isn't stored yet.
+
+    Each level of detail is stored under its own key (see `app.lib.utils.make_detail_key`).
+
+    :param tolerance: Simplification tolerance, in degrees
+    :param precision: Decimal places to round coordinates to
+    """
+    detail_key = make_detail_key(key, tolerance, precision)
+
+    async def compute():
+        value = await get_value(key, task, fn, *args, **kwargs)
+        simplified = await executor.run_in_thread(simplify_value, value, tolerance, precision)
+        await store_value_async(detail_key, simplified)
+        return simplified
+
+    value = await get_stored_value_async(detail_key)
+    if not value:
+        value = await single_flight.run(detail_key, compute)
+    return value
+
+
+async def get_result(request, key, task, fn, *args, **kwargs):
+    """
+    Get a stored result as a response (see `get_value`).
+
+    The response is built straight from the stored value, so cached results are not decoded and re-encoded.
+    """
+    value = await get_value(key, task, fn, *args, **kwargs)
+    return stored_response(request, value)
+
+
+async def stream_subcatchments(groups, res, remove_sinks, tolerance=0, precision=None):
+    """
+    Delineate outlets in the process pool, `stream_chunk_size` of a region at a time, yielding subcatchments as NDJSON
+    lines as soon as their chunk is done.
+
+    Each chunk is still split by all of its region's outlets (see `app.lib.delineation.delineate_subcatchments`). No
+    more chunks run at once than there are delineation processes, so the first lines are sent once the first chunks are
+    done, and memory doesn't grow with the size of the batch.
+
+    :param groups: Dict of region to list of (lon, lat) outlets (see `app.lib.delineation.group_points`)
+    :param tolerance: Simplification tolerance, in grid cells
+    :param precision: Decimal places to round coordinates to
+    """
+    chunks = [(region, points, start) for region, points in groups.items()
+              for start in range(0, len(points), stream_chunk_size)]
+    runs = {}
+    try:
+        while chunks or runs:
+            while chunks and len(runs) < executor.max_workers:
+                chunk = chunks.pop(0)
+                region, points, start = chunk
+                run = asyncio.ensure_future(
+                    executor.run(delineate_subcatchments, points, res=res, region=region, remove_sinks=remove_sinks,
+                                 start=start, stop=start + stream_chunk_size))
+                runs[run] = chunk
+
+            done, _ = await asyncio.wait(runs, return_when=asyncio.FIRST_COMPLETED)
+            for run in done:
+                chunk = runs.pop(run)
+                try:
+                    features = run.result()
+                except Saturated:
+                    # the response has started, so wait for room rather than failing it
+                    chunks.insert(0, chunk)
+                    await asyncio.sleep(1)
+                    continue
+                if tolerance or precision is not None:
+                    features = await asyncio.to_thread(
+                        simplify_features, features, tolerance=tolerance * res / 3600, precision=precision)
+                for feature in features:
+                    yield orjson.dumps(feature) + b'\n'
+    finally:
+        for run in runs:
+            run.cancel()
+
+
+async def run_job_locally(job_id, chunks, res, remove_sinks):
+    """
+    Work through a job's chunks in the delineation process pool, when there are no Celery workers to fan out to.
+    """
+    queue = list(chunks)
+
+    async def work():
+        while queue:
+            region, start, stop = queue.pop(0)
+            while True:
+                try:
+                    await executor.run(delineate_job_chunk, job_id, region, start, stop, res, remove_sinks)
+                    break
+                except Saturated:
+                    # leave room for interactive requests
+                    await asyncio.sleep(1)
+
+    await asyncio.gather(*[work() for _ in range(executor.max_workers)])
+    await asyncio.to_thread(finish_job, job_id)
+
+
+# jobs running in this process, referenced until they finish
+local_jobs = set()
+
+
+def too_many_requests():
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail='Too many delineations in progress; please try again shortly',
+    )
 
 
 v1 = FastAPI()
@@ -95,31 +324,100 @@ def root():
     return "Hello, Hydrologist!"
 
 
+@app.get('/health')
+def health(response: Response):
+    """
+    Readiness, for load balancers: 503 until data is prepared and warmed up.
+    """
+    if not app.ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {'ready': app.ready}
+
+
+@app.get('/metrics')
+def get_metrics(api_key: str = Security(get_api_key)):
+    return dict(metrics.snapshot(), celery_workers=len(worker_monitor.workers))
+
+
 @app.get('/ee_tile')
 async def get_ee_tile(dataset: str, threshold: int, api_key: str = Security(get_api_key)):
     try:
-        tile_url = app.ee.get_earth_engine_map_tile_url(dataset, threshold)
+        tile_url = await asyncio.to_thread(app.ee.get_earth_engine_map_tile_url, dataset, threshold)
         return tile_url
     except:
         return 'Earth Engine not initialized'
 
 
 @app.get('/tiles/streamlines')
-async def get_streamlines_raster(resolution: int, threshold: int, api_key: str = Security(get_api_key)):
+async def get_streamlines_raster(request: Request, resolution: int, threshold: int,
+                                 api_key: str = Security(get_api_key)):
+    """
+    Get the URL template of streamline tiles, from Earth Engine unless they are served locally (see
+    `get_streamlines_tile`) with STREAMLINE_TILES=local.
+    """
+    if streamline_tiles_source == 'local':
+        base_url = public_url.rstrip('/') + '/' if public_url else str(request.base_url)
+        query = urlencode({'resolution': resolution, 'threshold': threshold, 'api-key': api_key})
+        return f'{base_url}tiles/streamlines/{{z}}/{{x}}/{{y}}.png?{query}'
     try:
-        tile_url = app.ee.get_streamlines_raster(resolution, threshold)
+        tile_url = await asyncio.to_thread(app.ee.get_streamlines_raster, resolution, threshold)
         return tile_url
     except:
         return 'Earth Engine not initialized'
 
 
+@app.get('/tiles/streamlines/{z}/{x}/{y}.{ext}')
+async def get_streamlines_tile(request: Request, z: int, x: int, y: int, ext: str, resolution: int = 30,
+                               threshold: int = 50, showsinks: bool = True, palette: str = '0000FF',
+                               sink_color: str = 'red', api_key: str = Security(get_api_key)):
+    """
+    Get a streamlines tile, as PNG or MVT, rendered from the flow accumulation grids.
+    """
+    if ext not in tile_media_types or not 0 <= z <= max_zoom or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Tile not found')
+    if resolution not in resolutions or not 0 <= threshold <= 100:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail='Invalid resolution or threshold')
+    if ext == 'mvt':
+        get_format(request, 'mvt', (z, x, y))
+    else:
+        try:
+            palette = normalize_color(palette)
+            sink_color = normalize_color(sink_color)
+        except ValueError as err:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(err))
+    tile = await asyncio.to_thread(streamline_tiles.get_tile, z, x, y, res=resolution, threshold=threshold,
+                                   showsinks=showsinks, palette=palette, sink_color=sink_color, ext=ext)
+    return Response(content=tile, media_type=tile_media_types[ext], headers={'Cache-Control': 'public, max-age=86400'})
+
+
 @app.get('/catchment')
-async def delineate(lat: float = None, lon: float = None, res: int = 30, remove_sinks: bool = False,
-                    api_key: str = Security(get_api_key)):
+async def delineate(request: Request, lat: float = None, lon: float = None, res: int = 30,
+                    remove_sinks: bool = False, tolerance: float = 0, precision: int = None, format: str = None,
+                    z: int = None, x: int = None, y: int = None, api_key: str = Security(get_api_key)):
+    """
+    Delineate the catchment above a point.
+
+    For a lighter response (e.g., a preview at low zoom), outlines can be simplified by `tolerance` grid cells and
+    coordinates rounded to `precision` decimal places.
+
+    Besides GeoJSON, the catchment can be returned as WKB, GeoParquet, Arrow or a vector tile (clipped to tile z/x/y),
+    picked by `format` (wkb, parquet, arrow or mvt) or the Accept header.
+    """
+    name = get_format(request, format, (z, x, y))
     try:
-        key = make_catchment_key(lat, lon, res, remove_sinks=remove_sinks)
-        result = get_result(key, delineate_point, lon, lat, res=res, remove_sinks=remove_sinks)
-        return result
+        region, row, col = await asyncio.to_thread(locate_cell, lon, lat, res)
+        key = make_cell_key(region, res, row, col, remove_sinks=remove_sinks)
+        if tolerance or precision is not None:
+            value = await get_detail_value(key, tolerance * res / 3600, precision, delineate_point, delineate_cell,
+                                           lon, lat, res=res, remove_sinks=remove_sinks)
+        else:
+            value = await get_value(key, delineate_point, delineate_cell, lon, lat, res=res, remove_sinks=remove_sinks)
+        if name:
+            properties, geometries = await asyncio.to_thread(decode_features, value)
+            return await encoded_response(name, properties, geometries, (z, x, y))
+        return stored_response(request, value)
+    except Saturated:
+        raise too_many_requests()
     except:
         return 'Uh-oh!'
 
@@ -128,18 +426,84 @@ async def delineate(lat: float = None, lon: float = None, res: int = 30, remove_
 async def delineate_catchment(lat: float = None, lon: float = None, res: int = 30, remove_sinks: bool = False,
                               api_key: str = Security(get_api_key)):
     try:
-        geojson = delineate_point(lon, lat, res=res, remove_sinks=remove_sinks)
-        return geojson
+        geojson = await executor.run(_delineate_point, lon, lat, res=res, remove_sinks=remove_sinks)
+        return ORJSONResponse(geojson)
+    except Saturated:
+        raise too_many_requests()
     except:
         return 'Uh-oh!'
 
 
 @app.post('/delineate_catchments')
 async def delineate_catchments(res: int = 30, outlets: Outlets = None, remove_sinks: bool = False,
-                               api_key: str = Security(get_api_key)):
+                               stream: bool = False, tolerance: float = 0, precision: int = None,
+                               format: str = None, z: int = None, x: int = None, y: int = None,
+                               request: Request = None, api_key: str = Security(get_api_key)):
+    name = None if stream else get_format(request, format, (z, x, y))
     try:
         features = outlets.features
-        geojson = delineate_from_features(features, res=res, remove_sinks=remove_sinks)
-        return geojson
+        if stream:
+            groups = await asyncio.to_thread(group_points, features)
+            executor.check()
+            return StreamingResponse(stream_subcatchments(groups, res, remove_sinks, tolerance, precision),
+                                     media_type='application/x-ndjson')
+        if get_celery_worker_status():
+            geojson = await executor.run_in_thread(run_batch, features, res, remove_sinks)
+        else:
+            geojson = await executor.run(_delineate_points, features, res=res, remove_sinks=remove_sinks)
+        if tolerance or precision is not None:
+            geojson['features'] = await asyncio.to_thread(
+                simplify_features, geojson['features'], tolerance=tolerance * res / 3600, precision=precision)
+        if name:
+            properties, geometries = await asyncio.to_thread(split_features, geojson)
+            return await encoded_response(name, properties, geometries, (z, x, y))
+        return ORJSONResponse(geojson)
+    except Saturated:
+        raise too_many_requests()
     except:
         return 'Uh-oh!'
+
+
+@app.post('/jobs', status_code=status.HTTP_202_ACCEPTED)
+async def submit_delineation_job(res: int = 30, outlets: Outlets = None, remove_sinks: bool = False,
+                                 api_key: str = Security(get_api_key)):
+    features = outlets.features
+    job_id, chunks = await asyncio.to_thread(create_job, features, res, remove_sinks)
+    if get_celery_worker_status():
+        await asyncio.to_thread(submit_job, job_id, chunks, res=res, remove_sinks=remove_sinks)
+    else:
+        job = asyncio.create_task(run_job_locally(job_id, chunks, res, remove_sinks))
+        local_jobs.add(job)
+        job.add_done_callback(local_jobs.discard)
+    return await asyncio.to_thread(get_job, job_id)
+
+
+@app.get('/jobs/{job_id}')
+async def get_delineation_job(job_id: str, api_key: str = Security(get_api_key)):
+    job = await asyncio.to_thread(get_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Job not found')
+    return job
+
+
+@app.get('/jobs/{job_id}/result')
+async def get_delineation_job_result(job_id: str, api_key: str = Security(get_api_key)):
+    """
+    Get the subcatchments delineated by a job so far; while the job is running, these are partial results.
+    """
+    geojson = await asyncio.to_thread(get_job_results, job_id)
+    if geojson is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Job not found')
+    return ORJSONResponse(geojson)
+
+
+@app.on_event('startup')
+def startup():
+    worker_monitor.start()
+    threading.Thread(target=prepare_and_warm_up, daemon=True).start()
+
+
+@app.on_event('shutdown')
+def shutdown():
+    worker_monitor.stop()
+    executor.shutdown()
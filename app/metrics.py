@@ -0,0 +1,48 @@
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Metrics(object):
+    """
+    Minimal in-process counters and timings, exposed through the API's /metrics endpoint.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.timings = defaultdict(lambda: {'count': 0, 'total': 0.0, 'max': 0.0})
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timing = self.timings[name]
+            timing['count'] += 1
+            timing['total'] += seconds
+            timing['max'] = max(timing['max'], seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time)
+
+    def snapshot(self):
+        with self._lock:
+            timings = {}
+            for name, timing in self.timings.items():
+                timings[name] = {
+                    'count': timing['count'],
+                    'mean_ms': timing['total'] / timing['count'] * 1000 if timing['count'] else 0.0,
+                    'max_ms': timing['max'] * 1000,
+                }
+            return {'counters': dict(self.counters), 'timings': timings}
+
+
+metrics = Metrics()
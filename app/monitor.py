@@ -0,0 +1,79 @@
+import os
+import time
+import logging
+import threading
+
+import dotenv
+
+dotenv.load_dotenv()
+
+# seconds without a heartbeat after which a worker is considered gone
+worker_expiry = float(os.environ.get('CELERY_WORKER_EXPIRY', 10))
+
+
+class WorkerMonitor(object):
+    """
+    Tracks Celery worker liveness in the background, so requests can check it without touching the broker.
+
+    A daemon thread listens for worker heartbeat/online/offline events. If no events arrive for a while (or the
+    event receiver fails), it falls back to a ping broadcast, still off the request path.
+    """
+
+    def __init__(self, celery, expiry=worker_expiry):
+        self.celery = celery
+        self.expiry = expiry
+        self.workers = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._receiver = None
+
+    @property
+    def available(self):
+        now = time.monotonic()
+        return any(now - last_seen < self.expiry for last_seen in self.workers.values())
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='celery-worker-monitor', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._receiver is not None:
+            self._receiver.should_stop = True
+        self._thread = None
+
+    def _seen(self, event):
+        self.workers[event['hostname']] = time.monotonic()
+
+    def _gone(self, event):
+        self.workers.pop(event['hostname'], None)
+
+    def _ping(self):
+        try:
+            replies = self.celery.control.inspect(timeout=1).ping() or {}
+        except Exception as err:
+            logging.warning(f'Celery ping failed: {err}')
+            replies = {}
+        now = time.monotonic()
+        for hostname in replies:
+            self.workers[hostname] = now
+
+    def _capture(self):
+        with self.celery.connection() as connection:
+            self._receiver = self.celery.events.Receiver(connection, handlers={
+                'worker-heartbeat': self._seen,
+                'worker-online': self._seen,
+                'worker-offline': self._gone,
+            })
+            # raises a timeout if no events arrive within the expiry window
+            self._receiver.capture(limit=None, timeout=self.expiry, wakeup=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._capture()
+            except Exception:
+                self._ping()
+                self._stop.wait(self.expiry / 2)
@@ -1,15 +1,27 @@
 import os
+import sys
+import fcntl
 from pathlib import Path
 import json
 from itertools import product
+from contextlib import contextmanager
 
 import logging
 
 import requests
 
+import numpy as np
+
 import rasterio
 import rasterio.features
 import rasterio.warp
+import rasterio.windows
+
+from app.downloads import downloader, get_checksum
+from app.lib.grids import grids, get_memmap_paths, open_memmap, touch_pages
+from app.lib.index import build_upstream_index, index_arrays, index_dtype, get_upstream_index
+from app.lib.regions import region_index
+from app.lib.tiles import get_overview_factors, get_overview_paths, max_pool, sink_value, streamline_tiles_source
 
 from dotenv import load_dotenv
 
@@ -21,20 +33,33 @@ data_dir = os.environ.get('DATA_DIR', './instance/data')
 filename_tpl = 'hyd_{region}_{data}_{res}s.{ext}'
 
 
-def download_extract_hydrosheds(region, data, res, dest='./data', force=False):
-    src_data_url = os.environ['DATA_HTTP_URI']
-    tif_name = filename_tpl.format(region=region, data=data, res=res, ext='tif')
-    src_url = f'{src_data_url}/{tif_name}'
-    dst_path = Path(dest, tif_name)
+def download_files(fnames, dest, force=False):
+    """
+    Download files from the data store (DATA_HTTP_URI) in parallel, skipping those already present unless forced.
 
-    if force or not os.path.exists(dst_path):
-        print(f'Processing {tif_name}')
+    Files are verified against their published checksums, where there are any (see `app.downloads.get_checksum`).
+
+    :return: List of paths, in the order of `fnames`
+    """
+    paths = [Path(dest, fname) for fname in fnames]
+
+    files = []
+    for fname, dst_path in zip(fnames, paths):
+        if force or not os.path.exists(dst_path):
+            logging.info(f'Downloading {fname}')
+            src_url = f'{os.environ["DATA_HTTP_URI"]}/{fname}'
+            checksum = get_checksum(src_url)
+            if not checksum:
+                logging.warning(f'No checksum published for {fname}')
+            files.append((src_url, dst_path, checksum))
+    downloader.download_all(files)
 
-        req = requests.get(src_url)
+    return paths
 
-        with open(dst_path, 'wb') as f:
-            f.write(req.content)
 
+def download_extract_hydrosheds(region, data, res, dest='./data', force=False):
+    tif_name = filename_tpl.format(region=region, data=data, res=res, ext='tif')
+    [dst_path] = download_files([tif_name], dest, force=force)
     return dst_path
 
 
@@ -65,16 +90,142 @@ def mask_raster_to_vector(input_path):
     return gj
 
 
+def convert_to_memmap(tif_path, force=False, block_rows=1024):
+    """
+    Convert a single-band GeoTIFF to an uncompressed, memory-mappable array file.
+
+    The array is written next to the GeoTIFF with a `.dat` extension, along with a `.json` sidecar holding the
+    dtype, shape, affine transform, CRS and nodata value (see `app.lib.grids.open_memmap_raster`). The raster is
+    copied in blocks of rows, so the full grid is never held in memory.
+    """
+    tif_path = Path(tif_path)
+    array_path = tif_path.with_suffix('.dat')
+    meta_path = tif_path.with_suffix('.json')
+
+    if not force and array_path.exists() and meta_path.exists():
+        return array_path, meta_path
+
+    logging.info(f'Converting {tif_path.name} to a memory-mappable array')
+
+    tmp_path = array_path.with_suffix('.dat.tmp')
+    with rasterio.open(tif_path) as dataset:
+        shape = (dataset.height, dataset.width)
+        dtype = np.dtype(dataset.dtypes[0])
+        out = np.memmap(tmp_path, dtype=dtype, mode='w+', shape=shape)
+        for row in range(0, dataset.height, block_rows):
+            nrows = min(block_rows, dataset.height - row)
+            window = rasterio.windows.Window(0, row, dataset.width, nrows)
+            out[row:row + nrows] = dataset.read(1, window=window)
+        out.flush()
+        del out
+
+        meta = {
+            'dtype': dtype.str,
+            'shape': shape,
+            'affine': list(dataset.transform)[:6],
+            'crs': dataset.crs.to_string() if dataset.crs else 'EPSG:4326',
+            'nodata': dataset.nodata,
+        }
+
+    # rename last, so that readers never see a partially written array
+    os.replace(tmp_path, array_path)
+    with open(meta_path, 'w') as f:
+        f.write(json.dumps(meta))
+
+    return array_path, meta_path
+
+
+def build_index(region, res, force=False):
+    """
+    Build the upstream index used for fast delineation (see `app.lib.index.build_upstream_index`).
+
+    This is an offline step: it reads the full flow direction grid and needs roughly 20 bytes of memory per grid
+    cell. The index arrays are written as memory-mappable `.dat` files with `.json` sidecars, like the grid itself.
+    """
+    paths = [get_memmap_paths(region, res, data=data) for data in index_arrays]
+    if not force and all(os.path.exists(p) for pair in paths for p in pair):
+        return
+
+    dir_path, dir_meta_path = get_memmap_paths(region, res)
+    if not os.path.exists(dir_path):
+        tif_name = filename_tpl.format(region=region, data='dir', res=res, ext='tif')
+        convert_to_memmap(Path(data_dir, tif_name))
+    fdir, meta = open_memmap(dir_path, dir_meta_path)
+
+    logging.info(f'Building upstream index for {region} at {res}s')
+
+    dtype = index_dtype(fdir.shape)
+    arrays = [np.memmap(f'{array_path}.tmp', dtype=dtype, mode='w+', shape=(fdir.size,)) for array_path, _ in paths]
+    n = build_upstream_index(fdir, *arrays)
+    logging.info(f'Indexed {n} of {fdir.size} cells')
+
+    for array, (array_path, meta_path) in zip(arrays, paths):
+        array.flush()
+        os.replace(f'{array_path}.tmp', array_path)
+        with open(meta_path, 'w') as f:
+            f.write(json.dumps(dict(meta, dtype=dtype.str, nodata=None)))
+
+
+def build_tile_overviews(region, res, force=False):
+    """
+    Prepare a region's flow accumulation grid for serving tiles (see `app.lib.tiles`): convert it to a
+    memory-mappable array, and build overviews of it and of the sinks in the flow direction grid.
+
+    Each overview halves the one before, keeping the maximum of each 2x2 block of cells, so that streams and sinks
+    don't disappear when zoomed out. Overviews are written as memory-mappable arrays, like the grids themselves.
+    """
+    acc_tif_path = Path(data_dir, filename_tpl.format(region=region, data='acc', res=res, ext='tif'))
+    if not acc_tif_path.exists():
+        return
+    convert_to_memmap(acc_tif_path, force=force)
+
+    dir_path, dir_meta_path = get_memmap_paths(region, res)
+    if not os.path.exists(dir_path):
+        convert_to_memmap(Path(data_dir, filename_tpl.format(region=region, data='dir', res=res, ext='tif')))
+
+    acc, acc_meta = open_memmap(*get_memmap_paths(region, res, data='acc'))
+    fdir, dir_meta = open_memmap(dir_path, dir_meta_path)
+    acc_nodata = acc_meta['nodata']
+
+    def prepare_acc(block):
+        return np.where(block == acc_nodata, 0, block) if acc_nodata is not None else block
+
+    def prepare_sinks(block):
+        return (block == sink_value).astype(np.uint8)
+
+    for data, grid, meta, prepare in [('acc', acc, acc_meta, prepare_acc), ('snk', fdir, dir_meta, prepare_sinks)]:
+        for factor in get_overview_factors(grid.shape):
+            array_path, meta_path = get_overview_paths(region, res, data, factor)
+            if force or not (os.path.exists(array_path) and os.path.exists(meta_path)):
+                logging.info(f'Building {factor}x overview of {data} for {region} at {res}s')
+                shape = ((grid.shape[0] + 1) // 2, (grid.shape[1] + 1) // 2)
+                dtype = np.dtype(acc.dtype if data == 'acc' else np.uint8)
+                out = np.memmap(f'{array_path}.tmp', dtype=dtype, mode='w+', shape=shape)
+                max_pool(grid, out, prepare=prepare)
+                out.flush()
+                del out
+                os.replace(f'{array_path}.tmp', array_path)
+
+                affine = list(meta['affine'][:6])
+                affine[0] *= factor
+                affine[4] *= factor
+                with open(meta_path, 'w') as f:
+                    f.write(json.dumps(dict(meta, dtype=dtype.str, shape=shape, affine=affine, nodata=None)))
+
+            grid, _ = open_memmap(array_path, meta_path)
+            prepare = None
+
+
 def process_region(region, dest='./instance/data', force=False):
     if not os.path.exists(dest):
         os.makedirs(dest)
 
     # extract direction grids
-    for res in [15, 30]:
-        for ext in ['dir', 'acc', 'msk']:
-            if ext == 'msk' and res == 15:
-                continue
-            download_extract_hydrosheds(region, ext, res, dest=dest, force=False)
+    tif_names = [filename_tpl.format(region=region, data=ext, res=res, ext='tif')
+                 for res in [15, 30] for ext in ['dir', 'acc', 'msk'] if not (ext == 'msk' and res == 15)]
+    for dst_path in download_files(tif_names, dest):
+        if '_dir_' in dst_path.name:
+            convert_to_memmap(dst_path, force=force)
 
     # extract masks
     tif_name = filename_tpl.format(region=region, data='msk', res=30, ext='tif')
@@ -84,50 +235,116 @@ def process_region(region, dest='./instance/data', force=False):
     dst_path = Path(dest, mask_name)
 
     if force or not os.path.exists(dst_path):
-        vector = None
+        downloaded = False
         if not force:
-            src_data_url = os.environ['DATA_HTTP_URI']
-            src_url = f'{src_data_url}/{mask_name}'
-            req = requests.get(src_url)
-            if req.ok:
-                vector = req.content.decode()
+            try:
+                download_files([mask_name], dest)
+                downloaded = True
+            except requests.RequestException:
+                pass
 
-        if not vector:
+        if not downloaded:
             vector = mask_raster_to_vector(mask_path)
-
-        with open(dst_path, 'w') as f:
-            f.write(json.dumps(vector))
+            with open(dst_path, 'w') as f:
+                f.write(json.dumps(vector))
 
     return
 
 
-def initialize(regions, resolutions):
+@contextmanager
+def data_lock():
+    """
+    Hold an exclusive lock on the data directory while preparing data, so that only one process at a time does.
+    """
+    with open(os.path.join(data_dir, '.prepare.lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def initialize(regions, resolutions, tiles=None):
+    """
+    Prepare data: download any missing grids and masks, in parallel, and convert grids to memory-mappable arrays.
+
+    Nothing is loaded into memory; see `warm_up`. This can be run as a separate step with `python -m app.setup prepare`.
+
+    :param tiles: Whether to also prepare the flow accumulation grids and overviews for local streamline tiles (see
+        `build_tile_overviews`); by default, if STREAMLINE_TILES is 'local'
+    """
     logging.info('Initializing data...')
 
+    if tiles is None:
+        tiles = streamline_tiles_source == 'local'
+
     if not os.path.exists(data_dir):
         os.makedirs(data_dir)
 
-    for region, res, data_type in product(regions, resolutions, ['dir', 'msk']):
+    # other processes (e.g., other API workers) wait, then find the data prepared
+    with data_lock():
+        data_types = ['dir', 'msk', 'acc'] if tiles else ['dir', 'msk']
+        fnames = []
+        for region, res, data_type in product(regions, resolutions, data_types):
+            if data_type == 'msk' and res == 15:
+                continue
+            ext = 'json' if data_type == 'msk' else 'tif'
+            fnames.append(filename_tpl.format(region=region, data=data_type, res=res, ext=ext))
 
-        if data_type == 'msk' and res == 15:
-            continue
+        for fpath in download_files(fnames, data_dir):
+            if '_dir_' in fpath.name:
+                convert_to_memmap(fpath)
 
-        ext = 'json' if data_type == 'msk' else 'tif'
-        mode = 'w' if data_type == 'msk' else 'wb'
-        fname = filename_tpl.format(region=region, data=data_type, res=res, ext=ext)
-        fpath = f'{data_dir}/{fname}'
+        if tiles:
+            for region, res in product(regions, resolutions):
+                build_tile_overviews(region, res)
 
-        if not os.path.exists(fpath):
-            logging.info(f'Downloading {fname}')
-            data_http_uri = os.environ.get('DATA_HTTP_URI')
-            url = f'{data_http_uri}/{fname}'
-            req = requests.get(url)
-            with open(fpath, mode) as f:
-                f.write(req.content if mode == 'wb' else req.content.decode())
+
+def warm_up(regions, resolutions, touch=True):
+    """
+    Load (or map) the given grids, their upstream indexes and the region masks and lookup grid, so that the first
+    delineation in each region doesn't pay for it. Memory-mapped grids and indexes are read through, so they're in the
+    OS page cache, shared by every process, rather than read from disk on first use.
+
+    Run this once the data is prepared (see `initialize`); the region lookup grid is rebuilt if masks appear later.
+
+    :param touch: Whether to read through memory-mapped grids and indexes; other processes only need to map them once
+        one has
+    """
+    logging.info(f'Warming up {", ".join(regions)} at {", ".join(f"{res}s" for res in resolutions)}')
+    region_index.lookup_codes([0], [0])
+    for region in regions:
+        region_index.get_mask(region)
+        for res in resolutions:
+            _, fdir = grids.get(region, res)
+            index = get_upstream_index(region, res)
+            if not touch:
+                continue
+            touch_pages(fdir)
+            if index is not None:
+                for array in (index.pre, index.ups, index.order):
+                    touch_pages(array)
+
+
+def warm_up_process(regions, resolutions):
+    """
+    Warm up a delineation process (see `app.executor`), mapping the grids that the API has already read through.
+    """
+    try:
+        warm_up(regions, resolutions, touch=False)
+    except Exception as err:
+        # a failing initializer would break the whole pool; grids are loaded on first use instead
+        logging.warning(f'Could not warm up delineation process: {err}')
 
 
 if __name__ == '__main__':
     regions = ['eu', 'as', 'af', 'na', 'sa', 'au']
     resolutions = [15, 30]
+    if sys.argv[1:] == ['prepare']:
+        initialize(regions, resolutions)
+        sys.exit()
     for region in regions:
         process_region(region, force=True)
+        for res in resolutions:
+            build_index(region, res, force=True)
+            build_tile_overviews(region, res, force=True)
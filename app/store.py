@@ -1,7 +1,24 @@
 import os
+import gzip
+import json
+import time
+import struct
 import logging
+import threading
+from collections import OrderedDict
 
+import numpy as np
+import orjson
+import shapely
 from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from app.metrics import metrics
 
 import dotenv
 
@@ -10,25 +27,322 @@ dotenv.load_dotenv()
 redis_port = os.environ.get('REDIS_PORT', 6379)
 redis_host = os.environ.get('REDIS_HOST', 'localhost')
 redis_password = os.environ.get('REDIS_PASSWORD')
+
+# how cached results are encoded (see `codecs`), how long they are kept, and the largest value worth caching
+cache_codec = os.environ.get('CACHE_CODEC', 'gzip')
+cache_ttl = int(os.environ.get('CACHE_TTL', 30 * 24 * 60 * 60)) or None
+cache_max_value_mb = float(os.environ.get('CACHE_MAX_VALUE_MB', 16))
+
+# in-process cache of stored values, in front of Redis
+local_cache_max_mb = float(os.environ.get('LOCAL_CACHE_MAX_MB', 256))
+local_cache_ttl = int(os.environ.get('LOCAL_CACHE_TTL', 60 * 60))
+
+# optional separate Redis for cached results (e.g., 'redis://cache:6379/0'), so it can be bounded with its own
+# maxmemory and eviction policy without evicting jobs, locks or Celery state from the main Redis
+cache_redis_url = os.environ.get('CACHE_REDIS_URL')
+
 try:
     redis = Redis(
         host=redis_host,
         port=redis_port,
         password=redis_password
     )
+    async_redis = AsyncRedis(
+        host=redis_host,
+        port=redis_port,
+        password=redis_password
+    )
     logging.info(f'Starting with REDIS on server {redis_host}')
 
 except:
     redis = None
+    async_redis = None
     logging.warning('Starting without REDIS')
 
+if redis and cache_redis_url:
+    cache_redis = Redis.from_url(cache_redis_url)
+    cache_async_redis = AsyncRedis.from_url(cache_redis_url)
+    logging.info('Caching results in a separate REDIS')
+else:
+    cache_redis = redis
+    cache_async_redis = async_redis
+
+
+class JSONCodec(object):
+    """
+    Plain JSON, as the API returns it.
+    """
+    name = 'json'
+    content_encoding = None
+
+    def encode(self, result):
+        return orjson.dumps(result, option=orjson.OPT_SERIALIZE_NUMPY)
+
+    def decode(self, value):
+        return orjson.loads(value)
+
+    def to_json(self, value):
+        return value
+
+    def decode_features(self, value):
+        """
+        Decode a stored FeatureCollection into its features' properties and geometries.
+
+        Geometries are parsed by GEOS straight from the JSON, without building GeoJSON dicts for them.
+
+        :return: (list, array) tuple of each feature's properties and its shapely geometry
+        """
+        data = self.to_json(value)
+        properties = [feature.get('properties') or {} for feature in orjson.loads(data)['features']]
+        geometries = shapely.get_parts(shapely.from_geojson(data)) if properties else np.array([], dtype=object)
+        return properties, geometries
+
+
+class GzipCodec(JSONCodec):
+    """
+    Gzipped JSON. Clients accepting gzip are sent the stored bytes as they are.
+    """
+    name = 'gzip'
+    content_encoding = 'gzip'
+
+    def encode(self, result):
+        return gzip.compress(super().encode(result), compresslevel=6)
+
+    def decode(self, value):
+        return orjson.loads(self.to_json(value))
+
+    def to_json(self, value):
+        return gzip.decompress(value)
+
+
+class ZstdCodec(JSONCodec):
+    """
+    Zstandard-compressed JSON: smaller and faster than gzip, and also sent as is to clients that accept it.
+    """
+    name = 'zstd'
+    content_encoding = 'zstd'
+
+    def encode(self, result):
+        return zstandard.ZstdCompressor(level=3).compress(super().encode(result))
+
+    def decode(self, value):
+        return orjson.loads(self.to_json(value))
+
+    def to_json(self, value):
+        return zstandard.ZstdDecompressor().decompress(value)
+
+
+class WKBCodec(JSONCodec):
+    """
+    The most compact encoding: geometries as WKB, everything else as JSON, compressed together.
+
+    Layout (before compression): a 4-byte length and the JSON of the result with geometries removed, followed by a
+    4-byte length and WKB for each feature's geometry.
+    """
+    name = 'wkb'
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=3).compress(data) if zstandard else gzip.compress(data)
+
+    def decompress(self, value):
+        return zstandard.ZstdDecompressor().decompress(value) if zstandard else gzip.decompress(value)
+
+    def encode(self, result):
+        features = result.get('features', [])
+        skeleton = dict(result, features=[dict(f, geometry=None) for f in features])
+        geometries = shapely.from_geojson([json.dumps(f['geometry']) for f in features]) if features else []
+
+        parts = [orjson.dumps(skeleton, option=orjson.OPT_SERIALIZE_NUMPY)]
+        parts.extend(shapely.to_wkb(geometries))
+        data = b''.join(struct.pack('<I', len(part)) + part for part in parts)
+        return self.compress(data)
+
+    def decode(self, value):
+        result, geometries = self._split(value)
+        for feature, geometry in zip(result['features'], geometries):
+            feature['geometry'] = json.loads(shapely.to_geojson(geometry))
+        return result
+
+    def decode_features(self, value):
+        result, geometries = self._split(value)
+        return [feature.get('properties') or {} for feature in result['features']], geometries
+
+    def _split(self, value):
+        data = self.decompress(value)
+        parts = []
+        offset = 0
+        while offset < len(data):
+            (size,) = struct.unpack_from('<I', data, offset)
+            parts.append(data[offset + 4:offset + 4 + size])
+            offset += 4 + size
+
+        return orjson.loads(parts[0]), shapely.from_wkb(parts[1:])
+
+    def to_json(self, value):
+        return super().encode(self.decode(value))
+
+
+class LocalCache(object):
+    """
+    Bounded, in-process LRU cache of stored values (encoded bytes), keyed like Redis.
+
+    Hot catchments are then served without a Redis round trip. Entries expire after `ttl` seconds so they don't
+    outlive their Redis counterparts by much; bumping CACHE_VERSION (see `app.lib.utils.make_cell_key`)
+    changes every key, so stale entries are simply never read again and age out.
+    """
+
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.nbytes = 0
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                self._pop(key)
+                return None
+            self._values.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._pop(key)
+            self._values[key] = (value, expires)
+            self.nbytes += len(value)
+            while self.nbytes > self.max_bytes:
+                self._pop(next(iter(self._values)))
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self.nbytes = 0
+
+    def _pop(self, key):
+        entry = self._values.pop(key, None)
+        if entry is not None:
+            self.nbytes -= len(entry[0])
+
+
+local_cache = LocalCache(int(local_cache_max_mb * 1024 * 1024), ttl=local_cache_ttl)
+
+
+codecs = {codec.name: codec for codec in [JSONCodec(), GzipCodec(), ZstdCodec(), WKBCodec()]}
+codec_ids = {'json': 0, 'gzip': 1, 'zstd': 2, 'wkb': 3}
+
+# stored values start with a magic prefix and a codec id; anything else is a legacy, plain JSON value
+magic = b'\x00FD'
+
+if cache_codec not in codecs:
+    raise Exception(f'Unknown cache codec: {cache_codec}')
+if cache_codec == 'zstd' and not zstandard:
+    logging.warning('zstandard is not installed; caching with gzip instead')
+    cache_codec = 'gzip'
+
+
+def encode_result(result, codec=None):
+    codec = codecs[codec or cache_codec]
+    return magic + bytes([codec_ids[codec.name]]) + codec.encode(result)
+
+
+def get_codec(value):
+    if value[:len(magic)] == magic:
+        codec_id = value[len(magic)]
+        name = next(name for name, i in codec_ids.items() if i == codec_id)
+        return codecs[name], value[len(magic) + 1:]
+    return codecs['json'], value
+
+
+def decode_result(value):
+    codec, payload = get_codec(value)
+    return codec.decode(payload)
+
+
+def decode_features(value):
+    codec, payload = get_codec(value)
+    return codec.decode_features(payload)
+
+
+def to_payload(value, accept_encoding=''):
+    """
+    Turn a stored value into a JSON response body, without parsing it if possible.
+
+    :param value: Stored value
+    :param accept_encoding: The client's Accept-Encoding header
+    :return: (bytes, str) tuple of the body and its Content-Encoding (None if not compressed)
+    """
+    codec, payload = get_codec(value)
+    accepted = [encoding.split(';')[0].strip() for encoding in accept_encoding.split(',')]
+    if codec.content_encoding and codec.content_encoding in accepted:
+        return payload, codec.content_encoding
+    return codec.to_json(payload), None
+
+
+def is_storable(value):
+    return len(value) <= cache_max_value_mb * 1024 * 1024
+
+
+def _storable(value):
+    if not is_storable(value):
+        logging.info(f'Not caching a value of {len(value)} bytes')
+        return False
+    return True
+
+
+def _get_local(key):
+    value = local_cache.get(key)
+    metrics.incr('local_cache_hits' if value else 'local_cache_misses')
+    return value
+
+
+def _got_stored(key, stored_value):
+    if stored_value and stored_value != b'null':
+        metrics.incr('redis_cache_hits')
+        local_cache.set(key, stored_value)
+        return stored_value
+    metrics.incr('redis_cache_misses')
+
+
+def get_stored_value(key):
+    value = _get_local(key)
+    if value:
+        return value
+    if cache_redis:
+        return _got_stored(key, cache_redis.get(key))
+
 
 def get_stored_result(key):
-    if redis:
-        stored_value = redis.get(key)
-        if stored_value and stored_value != b'null':
-            return stored_value.decode()
+    stored_value = get_stored_value(key)
+    if stored_value:
+        return decode_result(stored_value)
+
+
+def store_value(key, value):
+    if _storable(value):
+        local_cache.set(key, value)
+        cache_redis.set(key, value, ex=cache_ttl)
+
+
+async def get_stored_value_async(key):
+    value = _get_local(key)
+    if value:
+        return value
+    if cache_async_redis:
+        return _got_stored(key, await cache_async_redis.get(key))
 
 
-def store_result(key, value):
-    redis.set(key, value)
+async def store_value_async(key, value):
+    if _storable(value):
+        local_cache.set(key, value)
+        await cache_async_redis.set(key, value, ex=cache_ttl)
@@ -1,12 +1,19 @@
 import os
-import json
+import logging
 
-from celery import Celery
+from celery import Celery, chord
+from celery.signals import celeryd_after_setup, worker_process_init
 
-from app.lib.delineation import delineate_point as _delineate_point, delineations_to_subcatchments
+from app.lib.delineation import delineate_subcatchments as _delineate_subcatchments, group_points, unique_points
+from app.lib.grids import grids
+from app.lib.regions import region_codes, get_region
+from app.setup import warm_up
 
-from app.lib.utils import make_catchment_key
-from app.store import get_stored_result, store_result
+from app.lib.utils import make_cell_key
+from app.store import get_stored_result, decode_result, encode_result, store_value
+from app.coalesce import run_once
+from app.cells import locate_cell, delineate_cell
+from app.jobs import get_job_outlets, record_chunk, finish_job
 
 import dotenv
 
@@ -17,43 +24,207 @@ redis_password = os.environ.get('REDIS_PASSWORD')
 if redis_password:
     redis_host = f':{redis_password}@{redis_host}'
 redis_url = f'redis://{redis_host}'
+
+# seconds task results are kept; a chord's bookkeeping is renewed as each of its tasks finishes, so this only needs to
+# cover the wait for the next one, even in long jobs (which keep their results with the job, see `app.jobs`)
+result_expires = int(os.environ.get('RESULT_EXPIRES', 60 * 60))
+
 celery = Celery(
     __name__,
     broker=os.environ.get("CELERY_BROKER_URL", redis_url),
     backend=os.environ.get("CELERY_RESULT_BACKEND", redis_url),
-    expires=60  # results expire after 1 minute
+    result_expires=result_expires
 )
 
+# the regions and resolutions this worker serves, e.g. 'na,sa'; by default, all of them (without preloading grids)
+worker_regions = os.environ.get('WORKER_REGIONS')
+worker_resolutions = [int(res) for res in os.environ.get('WORKER_RESOLUTIONS', '15,30').split(',')]
+
+
+def region_queue(region, res):
+    return f'delineate.{region}.{res}'
+
+
+def route_task(name, args, kwargs, options, task=None, **kw):
+    """
+    Send delineations to the queue of the grid they need, so they go to workers that have it loaded.
+
+    Tasks that don't need a grid, and outlets outside every region, go to the default queue.
+    """
+    try:
+        if name == 'delineate_point':
+            lon, lat = args[:2]
+            res = args[2] if len(args) > 2 else kwargs.get('res', 30)
+            region = get_region(lon, lat)
+        elif name == 'delineate_from_feature':
+            lon, lat = args[0]['geometry']['coordinates']
+            res = args[1]
+            region = get_region(lon, lat)
+        elif name == 'delineate_subcatchments':
+            _, res, region = args[:3]
+        elif name == 'delineate_job_chunk':
+            _, region, _, _, res = args[:5]
+        else:
+            return None
+    except Exception:
+        return None
+
+    return {'queue': region_queue(region, res)}
+
+
+celery.conf.task_routes = (route_task,)
+
+
+@celeryd_after_setup.connect
+def subscribe_to_regions(sender, instance, **kwargs):
+    regions = worker_regions.split(',') if worker_regions else region_codes
+    for region in regions:
+        for res in worker_resolutions:
+            instance.app.amqp.queues.select_add(region_queue(region, res))
+
+
+@celeryd_after_setup.connect
+def warm_up_worker(sender, instance, **kwargs):
+    """
+    Map the grids this worker serves and read them into the OS page cache, before it starts taking tasks.
+
+    This runs once, in the main worker process, whatever the pool (prefork, eventlet, threads or solo); the page cache
+    is shared with any child processes.
+    """
+    if not worker_regions:
+        return
+    try:
+        warm_up(worker_regions.split(','), worker_resolutions)
+    except Exception as err:
+        logging.warning(f'Could not warm up grids: {err}')
+
+
+@worker_process_init.connect
+def preload_grids(**kwargs):
+    # prefork children also map the grids before their first task; the pages are already cached
+    if not worker_regions:
+        return
+    for region in worker_regions.split(','):
+        for res in worker_resolutions:
+            try:
+                grids.get(region, res)
+            except Exception as err:
+                logging.warning(f'Could not preload the {region} {res}s grid: {err}')
+
 
 @celery.task(name='delineate_point')
 def delineate_point(lon, lat, res=30, remove_sinks=False):
-    return _delineate_point(lon, lat, res=res, remove_sinks=remove_sinks)
+    return delineate_cell(lon, lat, res=res, remove_sinks=remove_sinks)
 
 
-@celery.task(name='delineate_from_feature')
-def delineate_from_feature(feature, res, remove_sinks):
+def delineate_feature(feature, res, remove_sinks):
     lon, lat = feature['geometry']['coordinates']
 
-    key = make_catchment_key(lat, lon, res, remove_sinks=remove_sinks)
-    result = get_stored_result(key)
-    if result:
-        delineation = json.loads(result)
-    else:
-        delineation = _delineate_point(lon, lat, res=res, remove_sinks=remove_sinks)
+    region, row, col = locate_cell(lon, lat, res)
+    key = make_cell_key(region, res, row, col, remove_sinks=remove_sinks)
+    delineation = get_stored_result(key)
+    if not delineation:
+        def compute():
+            value = encode_result(delineate_cell(lon, lat, res=res, remove_sinks=remove_sinks))
+            store_value(key, value)
+            return value
 
-    store_result(key, json.dumps(delineation))
+        # another worker may already be delineating this outlet
+        delineation = decode_result(run_once(key, compute))
 
     return delineation
 
 
-@celery.task(name='delineate_from_features')
-def delineate_from_features(features, res=30, remove_sinks=False):
-    n = len(features)
-    resolutions = [res] * n
-    remove_sinkss = [remove_sinks] * n
-
-    delineations = ~delineate_from_feature.starmap(zip(features, resolutions, remove_sinkss))
-
-    catchments = delineations_to_subcatchments(delineations)
-
-    return catchments
+@celery.task(name='delineate_from_feature')
+def delineate_from_feature(feature, res, remove_sinks):
+    return delineate_feature(feature, res, remove_sinks)
+
+
+def delineate_job_chunk(job_id, region, start, stop, res, remove_sinks):
+    """
+    Delineate the subcatchments of a chunk of a job's outlets in a region, and record them (or the error) with the job.
+
+    Like `app.lib.delineation.delineate_subcatchments`, the chunk is still split by all of the job's outlets in the
+    region, so chunks don't overlap.
+    """
+    points, positions = get_job_outlets(job_id, region)
+    try:
+        features = _delineate_subcatchments(points, res=res, region=region, remove_sinks=remove_sinks,
+                                            start=start, stop=stop)
+        record_chunk(job_id, positions[start:stop], features=features)
+    except Exception as err:
+        record_chunk(job_id, positions[start:stop], error=str(err))
+
+
+@celery.task(name='delineate_job_chunk')
+def delineate_job_chunk_task(job_id, region, start, stop, res, remove_sinks):
+    # job results are kept with the job, so there's nothing to hand back to the chord
+    delineate_job_chunk(job_id, region, start, stop, res, remove_sinks)
+
+
+@celery.task(name='finish_job')
+def finish_job_task(_, job_id):
+    finish_job(job_id)
+
+
+def submit_job(job_id, chunks, res=30, remove_sinks=False):
+    """
+    Fan a job's chunks out across workers, one task each, and mark the job done when all are.
+
+    :param chunks: List of (region, start, stop) chunks (see `app.jobs.create_job`)
+    """
+    if not chunks:
+        finish_job(job_id)
+        return
+    header = [
+        delineate_job_chunk_task.s(job_id, region, start, stop, res, remove_sinks)
+        for region, start, stop in chunks
+    ]
+    return chord(header)(finish_job_task.s(job_id))
+
+
+@celery.task(name='delineate_subcatchments')
+def delineate_subcatchments(points, res, region, remove_sinks):
+    points = [tuple(point) for point in points]
+    return _delineate_subcatchments(points, res=res, region=region, remove_sinks=remove_sinks)
+
+
+@celery.task(name='merge_subcatchments')
+def merge_subcatchments(chunks, points):
+    """
+    Combine the subcatchments of each region into one FeatureCollection, in the order of the outlets.
+    """
+    subcatchments = {}
+    for features in chunks:
+        for feature in features:
+            props = feature['properties']
+            subcatchments[(props['outlet_lon'], props['outlet_lat'])] = feature
+
+    geojson = {
+        'type': 'FeatureCollection',
+        'features': [subcatchments[tuple(point)] for point in points],
+    }
+
+    return geojson
+
+
+def delineate_features(features, res=30, remove_sinks=False):
+    """
+    Make a chord delineating a batch of outlets in parallel, one task per (region, res).
+
+    Each region's outlets are labelled together in a single pass over its grid, which also nests them, so chunks are
+    independent of each other and only need merging.
+    """
+    header = [
+        delineate_subcatchments.s(points, res, region, remove_sinks)
+        for region, points in group_points(features).items()
+    ]
+    return chord(header, merge_subcatchments.s(unique_points(features)))
+
+
+@celery.task(name='delineate_from_features', bind=True)
+def delineate_from_features(self, features, res=30, remove_sinks=False):
+    batch = delineate_features(features, res=res, remove_sinks=remove_sinks)
+    if self.request.called_directly:
+        return batch.apply().get()
+    raise self.replace(batch)
@@ -0,0 +1,145 @@
+import datetime as dt
+import glob
+import json
+import os
+import subprocess
+import threading
+import time
+
+import numpy as np
+import orjson
+
+from app.setup import initialize, build_index
+from app.store import encode_result, to_payload
+from app.lib.delineation import get_region, delineate_point
+from app.lib.grids import get_grid
+from app.lib.index import get_upstream_index
+from app.lib.tracing import trace_catchment
+from app.tasks import celery, delineate_features
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def load_outlets():
+    outlets = []
+    for fpath in sorted(glob.glob('./examples/*.json')):
+        with open(fpath) as f:
+            gj = json.load(f)
+        features = gj['features'] if gj['type'] == 'FeatureCollection' else [gj]
+        for feature in features:
+            lon, lat = feature['geometry']['coordinates']
+            outlets.append((fpath, lon, lat))
+    return outlets
+
+
+def time_it(fn, *args, repeat=3, **kwargs):
+    result = None
+    elapsed = []
+    for i in range(repeat):
+        start_time = dt.datetime.now()
+        result = fn(*args, **kwargs)
+        elapsed.append((dt.datetime.now() - start_time).total_seconds())
+    return result, min(elapsed)
+
+
+class Benchmark(object):
+
+    def __init__(self, regions, resolutions=(30,)):
+        print('Setting up benchmark environment')
+        initialize(regions, resolutions)
+        self.regions = regions
+
+    def bench_upstream_index(self, res=30):
+        print(f'Upstream index vs. pysheds tracing ({res}s)')
+        for region in self.regions:
+            build_index(region, res)
+
+        for fpath, lon, lat in load_outlets():
+            region = get_region(lon, lat)
+            if region not in self.regions:
+                continue
+            _, fdir = get_grid(region, res)
+            index = get_upstream_index(region, res)
+
+            (_, traced), traced_time = time_it(trace_catchment, fdir, lon, lat)
+            (_, indexed), indexed_time = time_it(index.trace, fdir, lon, lat)
+
+            n_cells = int(np.asarray(traced).sum())
+            assert n_cells == int(np.asarray(indexed).sum())
+            print(f'{fpath} ({lon:.4f}, {lat:.4f}): {n_cells} cells, '
+                  f'pysheds {traced_time * 1000:.1f} ms, index {indexed_time * 1000:.1f} ms')
+
+    def bench_responses(self, res=30):
+        """
+        Serializing the largest example catchment: FastAPI's default path for a returned dict (`jsonable_encoder`, then
+        the stdlib `json`), orjson, and a cached result sent as stored.
+        """
+        from fastapi.encoders import jsonable_encoder
+
+        print(f'Response serialization ({res}s)')
+        delineations = [(fpath, delineate_point(lon, lat, res=res)) for fpath, lon, lat in load_outlets()
+                        if get_region(lon, lat) in self.regions]
+        fpath, geojson = max(delineations, key=lambda item: len(orjson.dumps(item[1])))
+        stored = encode_result(geojson, 'gzip')
+
+        timings = {
+            'jsonable_encoder + json': lambda: json.dumps(jsonable_encoder(geojson)).encode(),
+            'orjson': lambda: orjson.dumps(geojson, option=orjson.OPT_SERIALIZE_NUMPY),
+            'cached, decompressed': lambda: to_payload(stored)[0],
+            'cached, as stored (gzip)': lambda: to_payload(stored, 'gzip')[0],
+        }
+        print(f'{fpath}: {len(orjson.dumps(geojson)) / 1e6:.2f} MB of JSON, {len(stored) / 1e6:.2f} MB stored')
+        for name, fn in timings.items():
+            body, elapsed = time_it(fn, repeat=5)
+            print(f'{name}: {elapsed * 1000:.2f} ms ({len(body) / 1e6:.2f} MB)')
+
+    def bench_fan_out(self, worker_counts=(1, 2, 4), n_batches=8, res=30, port=6390):
+        """
+        Batch throughput against the number of Celery worker processes.
+
+        Requires fakeredis, which stands in for Redis as the broker and result backend.
+        """
+        from fakeredis import TcpFakeServer
+
+        print(f'Batch fan-out throughput ({res}s)')
+        server = TcpFakeServer(('127.0.0.1', port), server_type='redis')
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        redis_url = f'redis://127.0.0.1:{port}'
+        celery.conf.update(broker_url=redis_url, result_backend=redis_url)
+        env = dict(os.environ, CELERY_BROKER_URL=redis_url, CELERY_RESULT_BACKEND=redis_url, REDIS_PORT=str(port))
+
+        features = []
+        for fpath, lon, lat in load_outlets():
+            if get_region(lon, lat) in self.regions:
+                features.append({'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [lon, lat]}})
+
+        def run_batches(n):
+            batches = [delineate_features(features, res=res).apply_async() for i in range(n)]
+            return [batch.get(timeout=600) for batch in batches]
+
+        for n_workers in worker_counts:
+            worker = subprocess.Popen(
+                ['celery', '-A', 'app.tasks', 'worker', '-l', 'warning', f'--concurrency={n_workers}'], env=env)
+            try:
+                # load the grids in every worker process first
+                run_batches(n_workers * 2)
+                start_time = time.perf_counter()
+                run_batches(n_batches)
+                elapsed = time.perf_counter() - start_time
+            finally:
+                worker.terminate()
+                try:
+                    worker.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    worker.kill()
+            print(f'{n_workers} workers: {n_batches} batches of {len(features)} outlets in {elapsed:.2f} s, '
+                  f'{n_batches * len(features) / elapsed:.1f} outlets/s')
+
+
+if __name__ == '__main__':
+    benchmark = Benchmark(['na', 'af', 'eu'])
+    benchmark.bench_upstream_index()
+    benchmark.bench_responses()
+    benchmark.bench_fan_out()
@@ -0,0 +1,117 @@
+import os
+import re
+import hashlib
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from functools import partial
+
+from app.downloads import Downloader, get_checksum
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    A stand-in for the data store: serves files with Range support, and cuts off the first response for each file
+    half way, to exercise resuming.
+    """
+    interrupted = set()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return self.send_error(404)
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        start = 0
+        match = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            if start >= len(data):
+                return self.send_error(416)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(data) - 1}/{len(data)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+
+        body = data[start:]
+        if path not in self.interrupted and not path.endswith('.sha256'):
+            self.interrupted.add(path)
+            body = body[:len(body) // 2]
+        self.wfile.write(body)
+
+
+class Test(object):
+
+    def __init__(self):
+        print('Setting up test environment')
+        self.src_dir = tempfile.mkdtemp()
+        self.dst_dir = tempfile.mkdtemp()
+        handler = partial(RangeRequestHandler, directory=self.src_dir)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def make_file(self, name, size, checksum=True):
+        data = os.urandom(size)
+        with open(os.path.join(self.src_dir, name), 'wb') as f:
+            f.write(data)
+        if checksum:
+            with open(os.path.join(self.src_dir, f'{name}.sha256'), 'w') as f:
+                f.write(f'{hashlib.sha256(data).hexdigest()}  {name}\n')
+        return data
+
+    def test_download_all(self, n_files=6):
+        sources = {f'file_{i}.tif': self.make_file(f'file_{i}.tif', 1_000_000 + i) for i in range(n_files)}
+        downloader = Downloader(max_workers=3, chunk_size=1 << 16)
+        files = [(f'{self.url}/{name}', os.path.join(self.dst_dir, name), get_checksum(f'{self.url}/{name}'))
+                 for name in sources]
+        downloader.download_all(files)
+
+        for name, data in sources.items():
+            with open(os.path.join(self.dst_dir, name), 'rb') as f:
+                assert f.read() == data
+            assert not os.path.exists(os.path.join(self.dst_dir, f'{name}.part'))
+
+    def test_checksum_mismatch(self):
+        self.make_file('bad.tif', 1000, checksum=False)
+        with open(os.path.join(self.src_dir, 'bad.tif.sha256'), 'w') as f:
+            f.write('0' * 64)
+        url = f'{self.url}/bad.tif'
+        try:
+            Downloader().download(url, os.path.join(self.dst_dir, 'bad.tif'), checksum=get_checksum(url))
+        except Exception as err:
+            assert 'Checksum mismatch' in str(err)
+        else:
+            raise AssertionError('Checksum mismatch not detected')
+        assert not os.path.exists(os.path.join(self.dst_dir, 'bad.tif'))
+
+    def test_missing(self):
+        assert get_checksum(f'{self.url}/missing.tif') is None
+        try:
+            Downloader().download(f'{self.url}/missing.tif', os.path.join(self.dst_dir, 'missing.tif'))
+        except Exception as err:
+            assert '404' in str(err)
+        else:
+            raise AssertionError('Missing file not reported')
+
+
+if __name__ == '__main__':
+    print('Initializing test')
+    test = Test()
+
+    print('Test parallel, resumed downloads')
+    test.test_download_all()
+
+    print('Test checksum verification')
+    test.test_checksum_mismatch()
+
+    print('Test missing files')
+    test.test_missing()
+
+    print('Test passed!')
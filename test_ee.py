@@ -0,0 +1,147 @@
+import time
+import threading
+from types import SimpleNamespace
+
+import fakeredis
+
+from app.helpers.ee import EarthEngineMap, MapIdCache
+
+
+class StubImage(object):
+    """
+    A stand-in for `ee.Image`, whose expressions do nothing but whose `getMapId` counts calls and takes a while, like
+    a round trip to Earth Engine.
+    """
+
+    def __init__(self, module):
+        self.module = module
+
+    def updateMask(self, *args):
+        return self
+
+    def gte(self, *args):
+        return self
+
+    def eq(self, *args):
+        return self
+
+    def visualize(self, **kwargs):
+        return self
+
+    def mosaic(self):
+        return self
+
+    def getMapId(self, params=None):
+        with self.module.lock:
+            self.module.calls += 1
+            n = self.module.calls
+        time.sleep(self.module.delay)
+        return {'tile_fetcher': SimpleNamespace(url_format=f'https://earthengine.test/map/{n}/{{z}}/{{x}}/{{y}}')}
+
+
+class StubEE(object):
+
+    def __init__(self, delay=0.2):
+        self.calls = 0
+        self.delay = delay
+        self.lock = threading.Lock()
+
+    def Image(self, dataset):
+        return StubImage(self)
+
+    def ImageCollection(self, images):
+        return StubImage(self)
+
+
+class Test(object):
+
+    def __init__(self):
+        print('Setting up test environment')
+        self.redis = fakeredis.FakeRedis()
+
+    def make_map(self, module, **kwargs):
+        return EarthEngineMap(module=module, map_ids=MapIdCache(redis=self.redis, **kwargs))
+
+    def test_memoized(self):
+        self.redis.flushall()
+        stub = StubEE()
+        ee_map = self.make_map(stub)
+        url = ee_map.get_streamlines_raster(30, 50)
+        assert ee_map.get_streamlines_raster(30, 50) == url
+        assert stub.calls == 1
+
+        ee_map.get_streamlines_raster(30, 60)
+        ee_map.get_streamlines_raster(30, 50, showsinks=False)
+        ee_map.get_earth_engine_map_tile_url('WWF/HydroSHEDS/30ACC', 50)
+        ee_map.get_earth_engine_map_tile_url('WWF/HydroSHEDS/30ACC', 50)
+        assert stub.calls == 4
+
+    def test_shared(self):
+        self.redis.flushall()
+        stub = StubEE()
+        url = self.make_map(stub).get_streamlines_raster(15, 50)
+
+        # another worker, with its own process cache
+        start_time = time.time()
+        assert self.make_map(stub).get_streamlines_raster(15, 50) == url
+        assert time.time() - start_time < stub.delay
+        assert stub.calls == 1
+
+    def test_background_refresh(self):
+        self.redis.flushall()
+        stub = StubEE(delay=0.5)
+        ee_map = self.make_map(stub, ttl=3, refresh_margin=2)
+        url = ee_map.get_streamlines_raster(30, 50)
+
+        # within the refresh margin: the cached URL is returned right away, and a new one made in the background
+        time.sleep(1.2)
+        start_time = time.time()
+        assert ee_map.get_streamlines_raster(30, 50) == url
+        assert time.time() - start_time < stub.delay
+
+        time.sleep(stub.delay * 2)
+        refreshed = ee_map.get_streamlines_raster(30, 50)
+        assert refreshed != url
+        assert stub.calls == 2
+
+        # other workers pick up the refreshed URL from Redis
+        assert self.make_map(stub).get_streamlines_raster(30, 50) == refreshed
+        assert stub.calls == 2
+
+    def test_without_redis(self):
+        stub = StubEE(delay=0)
+        ee_map = EarthEngineMap(module=stub, map_ids=MapIdCache(redis=None))
+        assert ee_map.get_streamlines_raster(30, 50) == ee_map.get_streamlines_raster(30, 50)
+        assert stub.calls == 1
+
+    def test_not_initialized(self):
+        ee_map = EarthEngineMap(module=None, map_ids=MapIdCache(redis=None))
+        ee_map.ee = None
+        try:
+            ee_map.get_streamlines_raster(30, 50)
+        except Exception as err:
+            assert 'not initialized' in str(err)
+        else:
+            raise AssertionError('Missing Earth Engine not reported')
+
+
+if __name__ == '__main__':
+    print('Initializing test')
+    test = Test()
+
+    print('Test memoized map ids')
+    test.test_memoized()
+
+    print('Test map ids shared between workers')
+    test.test_shared()
+
+    print('Test background refresh')
+    test.test_background_refresh()
+
+    print('Test without Redis')
+    test.test_without_redis()
+
+    print('Test without Earth Engine')
+    test.test_not_initialized()
+
+    print('Test passed!')